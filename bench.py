@@ -0,0 +1,544 @@
+"""Нагрузочные проверки и микробенчмарки бота
+
+Запуск:
+    python bench.py counters    - параллельные инкременты статистики и чтение /stats
+    python bench.py replies     - CPU и память на один ответ: цепочка elif и таблица ответов
+    python bench.py load        - сквозная нагрузка через локальную имитацию Bot API
+    python bench.py hll         - точность и память скетчей уникальных пользователей
+    python bench.py search      - время поиска по текстам разделов без кэша и из кэша
+    python bench.py fake-server - только имитация Bot API (для ручных проверок)
+"""
+import argparse
+import collections
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(REPO_DIR, "bench_results")
+
+# bot.py читает файл статистики из текущего каталога при импорте,
+# поэтому проверки работают во временном каталоге
+os.chdir(tempfile.mkdtemp(prefix="bot-bench-"))
+sys.path.insert(0, REPO_DIR)
+# Журнал на каждое обновление не нужен в выводе проверок
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import bot
+
+
+def bench_counters(args):
+    """Инкременты из многих потоков одновременно с чтением /stats и сбросами на диск"""
+    store = bot.StatsStore(flush_interval=0.05, flush_threshold=1000)
+    bot.stats_store = store
+    store.start()
+    client = bot.create_app().test_client()
+    labels = list(bot.DEFAULT_STATS)
+    stop = threading.Event()
+    errors = []
+    reads = 0
+
+    def writer(index):
+        label = labels[index % len(labels)]
+        for _ in range(args.increments):
+            store.increment(label)
+
+    def reader():
+        nonlocal reads
+        while not stop.is_set():
+            response = client.get('/stats')
+            if response.status_code != 200:
+                errors.append(response.status_code)
+            reads += 1
+
+    readers = [threading.Thread(target=reader) for _ in range(args.readers)]
+    writers = [threading.Thread(target=writer, args=(i,)) for i in range(args.threads)]
+    started = time.perf_counter()
+    for thread in readers + writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    stop.set()
+    for thread in readers:
+        thread.join()
+    store.close()
+
+    expected = args.threads * args.increments
+    total = sum(store.snapshot().values())
+    reloaded = sum(bot.StatsStore().snapshot().values())
+    print(f"Потоков: {args.threads}, инкрементов: {expected}, чтений /stats: {reads}")
+    print(f"Время: {elapsed:.2f} с, {expected / elapsed:,.0f} инкрементов/с")
+    print(f"Итог в памяти: {total}, после перезагрузки с диска: {reloaded}")
+    if errors or total != expected or reloaded != expected:
+        print(f"❌ Расхождение счётчиков или ошибки чтения: {errors[:5]}")
+        return 1
+    print("✅ Счётчики сошлись")
+    return 0
+
+
+def legacy_reply_body(chat_id, text):
+    """Сборка тела ответа так, как это делал handle_text_message до таблицы ответов"""
+    keyboard = {
+        "keyboard": [
+            ["📢 Новости", "🗓️ Расписание консультаций"],
+            ["📚 История кафедры", "🎓 Абитуриентам"],
+            ["👨‍🎓 Студентам", "⚽ Спортивная работа"],
+            ["🏅 Центр тестирования ГТО", "👨‍🏫 Сотрудники кафедры"]
+        ],
+        "resize_keyboard": True
+    }
+    section_text = None
+    for label, _, candidate in bot.SECTIONS:
+        if text == label:
+            section_text = candidate
+            break
+    if section_text is None:
+        payload = {"chat_id": chat_id, "text": bot.FALLBACK_TEXT, "parse_mode": None}
+    else:
+        payload = {"chat_id": chat_id, "text": section_text, "parse_mode": "HTML"}
+    payload["reply_markup"] = keyboard
+    # Так кодирует тело requests.post(json=...)
+    return json.dumps(payload, allow_nan=False).encode('utf-8')
+
+
+def table_reply_body(chat_id, text):
+    """Сборка тела ответа через таблицу ответов"""
+    table = bot.content.current()
+    response = table.get(text)
+    if response is None:
+        return bot.message_body(chat_id, table.fallback)
+    return b"".join(bot.message_body(chat_id, encoded) for encoded in response.parts)
+
+
+def measure_replies(build, texts, iterations):
+    started = time.process_time()
+    for i in range(iterations):
+        build(100000 + i, texts[i % len(texts)])
+    cpu_us = (time.process_time() - started) / iterations * 1e6
+
+    peaks = []
+    sizes = []
+    tracemalloc.start()
+    for i, text in enumerate(texts):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        body = build(100000 + i, text)
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+        sizes.append(len(body))
+        del body
+    tracemalloc.stop()
+    return cpu_us, sum(peaks) / len(peaks), sum(sizes) / len(sizes)
+
+
+def bench_replies(args):
+    """CPU и память на подготовку одного ответа до и после таблицы ответов"""
+    texts = [label for label, _, _ in bot.SECTIONS] + ["привет"]
+    print(f"{'Вариант':<18}{'CPU, мкс/ответ':>16}{'пик памяти, Б':>16}{'тело, Б':>10}")
+    results = {}
+    for name, build in (("elif + json.dumps", legacy_reply_body), ("таблица ответов", table_reply_body)):
+        results[name] = measure_replies(build, texts, args.iterations)
+        cpu_us, peak, size = results[name]
+        print(f"{name:<18}{cpu_us:>16.2f}{peak:>16.0f}{size:>10.0f}")
+    before, after = results["elif + json.dumps"][0], results["таблица ответов"][0]
+    print(f"Ускорение подготовки ответа: x{before / after:.1f}")
+    return 0
+
+
+# Допустимый расход памяти на скетч сверх его регистров: объекты скетча и
+# bytearray, ключ и запись в словаре хранилища (измерено около 260 Б)
+HLL_SKETCH_OVERHEAD = 512
+
+
+def bench_hll(args):
+    """Точность оценки HyperLogLog, объединение скетчей и память хранилища"""
+    sketch_bytes = 1 << args.precision
+    expected_error = 1.04 / sketch_bytes ** 0.5
+    print(f"Точность {args.precision}: скетч {sketch_bytes} Б, ожидаемая ошибка {expected_error:.1%}")
+    print(f"{'Уникальных':>12}{'средняя ошибка':>16}{'худшая':>10}")
+    failed = False
+    for cardinality in (100, 1000, 10000, 100000):
+        errors = []
+        for trial in range(args.trials):
+            sketch = bot.HyperLogLog(args.precision)
+            for chat_id in range(trial * 10 ** 7, trial * 10 ** 7 + cardinality):
+                sketch.add(chat_id)
+            errors.append(abs(sketch.count() - cardinality) / cardinality)
+        mean = sum(errors) / len(errors)
+        failed |= mean > 3 * expected_error
+        print(f"{cardinality:>12}{mean:>16.2%}{max(errors):>10.2%}")
+
+    # Объединение двух пересекающихся множеств оценивает их объединение
+    left, right = bot.HyperLogLog(args.precision), bot.HyperLogLog(args.precision)
+    for chat_id in range(30000):
+        left.add(chat_id)
+    for chat_id in range(20000, 50000):
+        right.add(chat_id)
+    union_error = abs(bot.HyperLogLog.union([left, right], args.precision).count() - 50000) / 50000
+    failed |= union_error > 3 * expected_error
+    print(f"Объединение 30 000 и 30 000 с пересечением 10 000: ошибка {union_error:.2%}")
+
+    # Полное хранилище: скетч на каждый раздел и общий, за все дни хранения
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    store = bot.AudienceStore(path=os.path.join(os.getcwd(), "audience"), precision=args.precision,
+                              retention_days=args.days)
+    now = time.time()
+    labels = [label for label, _, _ in bot.SECTIONS]
+    for day in range(args.days):
+        for index, label in enumerate(labels):
+            store.add(label, day * 1000 + index, now - day * 86400)
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    sketches = store.stats()["sketches"]
+    per_sketch = used / sketches
+    memory_limit = sketch_bytes + HLL_SKETCH_OVERHEAD
+    print(f"Хранилище за {args.days} дн.: {sketches} скетчей, регистры {sketches * sketch_bytes / 1024:.0f} КиБ, "
+          f"всего в памяти {used / 1024:.0f} КиБ ({per_sketch:.0f} Б на скетч, допустимо {memory_limit} Б)")
+    if failed:
+        print("❌ Ошибка оценки больше трёх стандартных")
+    if per_sketch > memory_limit:
+        print(f"❌ Скетч занимает больше 2**{args.precision} + {HLL_SKETCH_OVERHEAD} Б")
+        failed = True
+    if failed:
+        return 1
+    print("✅ Ошибка оценки и память в пределах ожидаемых")
+    return 0
+
+
+SEARCH_QUERIES = ["ГТО цена", "консультации вторник", "Аксенова", "кто заведующий кафедрой",
+                  "магистратура спорт", "расписание сессии", "кёрлинг", "как поступить"]
+
+
+def bench_search(args):
+    """Время сборки индекса и ответа на запрос: без кэша и из кэша"""
+    started = time.perf_counter()
+    table = bot.ResponseTable(bot.SECTIONS, bot.MENU_LAYOUT)
+    build_ms = (time.perf_counter() - started) * 1000
+    index = table.search
+    stats = index.stats()
+    print(f"Индекс: {stats['documents']} абзацев, {stats['terms']} основ, сборка таблицы с индексом {build_ms:.1f} мс")
+    print(f"{'Запрос':<28}{'без кэша, мкс':>15}{'из кэша, мкс':>14}  раздел")
+    worst = 0.0
+    for query in SEARCH_QUERIES:
+        terms = tuple(sorted(set(bot.search_terms(query))))
+        started = time.perf_counter()
+        for _ in range(args.iterations):
+            bot.search_terms(query)
+            result = index._search(terms)
+        cold_us = (time.perf_counter() - started) / args.iterations * 1e6
+        started = time.perf_counter()
+        for _ in range(args.iterations):
+            index.find(query)
+        cached_us = (time.perf_counter() - started) / args.iterations * 1e6
+        worst = max(worst, cold_us)
+        print(f"{query:<28}{cold_us:>15.1f}{cached_us:>14.1f}  {result.label if result else '—'}")
+    if worst >= 1000:
+        print(f"❌ Запрос без кэша дольше миллисекунды: {worst:.0f} мкс")
+        return 1
+    print(f"✅ Худший запрос без кэша: {worst:.0f} мкс")
+    return 0
+
+
+class FakeBotAPI(ThreadingHTTPServer):
+    """Имитация Bot API: getUpdates, sendMessage и управляющие методы /_bench/*
+
+    Обновления порождает сам сервер (POST /_bench/push), а по приходу
+    sendMessage считает задержку от постановки обновления в очередь до
+    ответа бота в том же чате. Задержка ответа, доля 429 и 5xx настраиваются.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, error_rate=0.0, rate_limit_rate=0.0, retry_after=1):
+        super().__init__(address, FakeBotAPIHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.cond = threading.Condition()
+        self.updates = collections.deque()
+        self.next_update_id = 1
+        self.pushed_at = collections.defaultdict(collections.deque)
+        self.latencies = []
+        self.counters = collections.Counter()
+        self.first_push = self.last_reply = None
+
+    def push(self, count, chats, rate):
+        """Поток синтетических нажатий кнопок из chats разных чатов"""
+        labels = [label for label, _, _ in bot.SECTIONS] + ["/start"]
+        interval = 1.0 / rate if rate > 0 else 0.0
+        started = time.monotonic()
+        for i in range(count):
+            if interval:
+                delay = started + i * interval - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            chat_id = 100000 + random.randrange(chats)
+            with self.cond:
+                now = time.monotonic()
+                self.first_push = self.first_push or now
+                self.pushed_at[chat_id].append(now)
+                self.updates.append({
+                    "update_id": self.next_update_id,
+                    "message": {
+                        "message_id": self.next_update_id,
+                        "date": int(time.time()),
+                        "chat": {"id": chat_id, "type": "private"},
+                        "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+                        "text": random.choice(labels)
+                    }
+                })
+                self.next_update_id += 1
+                self.counters["pushed"] += 1
+                self.cond.notify_all()
+
+    def get_updates(self, offset, timeout, limit):
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while self.updates and self.updates[0]["update_id"] < offset:
+                self.updates.popleft()
+            while not self.updates and time.monotonic() < deadline:
+                self.cond.wait(deadline - time.monotonic())
+                while self.updates and self.updates[0]["update_id"] < offset:
+                    self.updates.popleft()
+            return [update for _, update in zip(range(limit), self.updates)]
+
+    def send_message(self, payload):
+        if self.latency:
+            time.sleep(random.uniform(0.5, 1.5) * self.latency)
+        roll = random.random()
+        if roll < self.rate_limit_rate:
+            self.counters["429"] += 1
+            return 429, {"ok": False, "error_code": 429,
+                         "description": f"Too Many Requests: retry after {self.retry_after}",
+                         "parameters": {"retry_after": self.retry_after}}
+        if roll < self.rate_limit_rate + self.error_rate:
+            self.counters["500"] += 1
+            return 500, {"ok": False, "error_code": 500, "description": "Internal Server Error"}
+        
+        with self.cond:
+            pushed = self.pushed_at.get(payload["chat_id"])
+            if pushed:
+                now = time.monotonic()
+                self.latencies.append(now - pushed.popleft())
+                self.last_reply = now
+            self.counters["replies"] += 1
+        return 200, {"ok": True, "result": {"message_id": 1, "chat": {"id": payload["chat_id"]},
+                                            "date": int(time.time()), "text": payload.get("text", "")}}
+
+    def stats(self):
+        with self.cond:
+            return {
+                "counters": dict(self.counters),
+                "latencies": list(self.latencies),
+                "duration": (self.last_reply - self.first_push) if self.last_reply else 0.0
+            }
+
+
+class FakeBotAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Буферизованный вывод: заголовки и тело уходят одним пакетом,
+    # иначе Nagle и отложенный ACK добавляют ~40 мс к каждому ответу
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _request(self):
+        parts = urlsplit(self.path)
+        params = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            params.update(json.loads(self.rfile.read(length)))
+        return parts.path.rsplit("/", 1)[-1], parts.path, params
+
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        method, path, params = self._request()
+        server = self.server
+        if path == "/_bench/push":
+            threading.Thread(target=server.push, daemon=True,
+                             args=(params["count"], params["chats"], params["rate"])).start()
+            self._reply(200, {"ok": True})
+        elif path == "/_bench/stats":
+            self._reply(200, server.stats())
+        elif method == "getUpdates":
+            updates = server.get_updates(int(params.get("offset", 0)), float(params.get("timeout", 0)),
+                                         int(params.get("limit", 100)))
+            server.counters["getUpdates"] += 1
+            self._reply(200, {"ok": True, "result": updates})
+        elif method == "sendMessage":
+            self._reply(*server.send_message(params))
+        else:
+            self._reply(200, {"ok": True, "result": True})
+
+
+def run_fake_server(args):
+    """Запуск имитации Bot API; первая строка вывода — номер порта"""
+    server = FakeBotAPI(("127.0.0.1", args.port), latency=args.latency, error_rate=args.error_rate,
+                        rate_limit_rate=args.rate_limit_rate, retry_after=args.retry_after)
+    print(server.server_port, flush=True)
+    server.serve_forever()
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def bench_load(args):
+    """Сквозная нагрузка: имитация Bot API в отдельном процессе, бот — в этом"""
+    server = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "fake-server",
+         "--latency", str(args.latency), "--error-rate", str(args.error_rate),
+         "--rate-limit-rate", str(args.rate_limit_rate)],
+        stdout=subprocess.PIPE, text=True)
+    try:
+        port = int(server.stdout.readline())
+        api = f"http://127.0.0.1:{port}"
+
+        instance = bot.TelegramBot()
+        instance.token = "bench"
+        instance.base_url = f"{api}/botbench/"
+        # По умолчанию снимаем лимиты Telegram, чтобы измерять сам бот
+        instance.outbox.global_bucket = bot.TokenBucket(args.global_rate, args.global_rate)
+        instance.outbox.chat_rate = args.chat_rate
+        instance.outbox.chat_burst = args.chat_rate
+        threading.Thread(target=instance.run_polling, daemon=True).start()
+
+        usage_before = resource.getrusage(resource.RUSAGE_SELF)
+        requests.post(f"{api}/_bench/push", json={"count": args.updates, "chats": args.chats, "rate": args.rate})
+        deadline = time.monotonic() + args.timeout
+        while time.monotonic() < deadline:
+            stats = requests.get(f"{api}/_bench/stats").json()
+            if stats["counters"].get("replies", 0) >= args.updates:
+                break
+            time.sleep(0.2)
+        usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies = stats["latencies"]
+    replies = stats["counters"].get("replies", 0)
+    cpu = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+    result = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "params": {key: value for key, value in vars(args).items() if key != "func"},
+        "replies": replies,
+        "completed": replies >= args.updates,
+        "throughput_per_second": replies / stats["duration"] if stats["duration"] else 0.0,
+        "latency_ms": {name: percentile(latencies, fraction) * 1000
+                       for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))},
+        "cpu_seconds": cpu,
+        "cpu_ms_per_update": cpu / replies * 1000 if replies else 0.0,
+        "max_rss_mb": usage_after.ru_maxrss / 1024,
+        "server": stats["counters"],
+        "send_queue": instance.outbox.stats()
+    }
+
+    latency = result["latency_ms"]
+    print(f"Ответов: {replies} из {args.updates}{'' if result['completed'] else ' (не дождались)'}")
+    print(f"Пропускная способность: {result['throughput_per_second']:.1f} обновлений/с")
+    print(f"Задержка, мс: p50 {latency['p50']:.1f}, p95 {latency['p95']:.1f}, p99 {latency['p99']:.1f}")
+    print(f"CPU бота: {cpu:.2f} с ({result['cpu_ms_per_update']:.2f} мс на обновление), "
+          f"пик RSS {result['max_rss_mb']:.1f} МБ")
+    print(f"Ответы имитации: {stats['counters']}")
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    previous = sorted(name for name in os.listdir(RESULTS_DIR) if name.startswith("load-"))
+    path = os.path.join(RESULTS_DIR, f"load-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"Результат сохранён в {os.path.relpath(path, REPO_DIR)}")
+
+    if args.compare and previous:
+        with open(os.path.join(RESULTS_DIR, previous[-1]), encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"Сравнение с {previous[-1]}:")
+        for name, before, after in (
+            ("обновлений/с", baseline["throughput_per_second"], result["throughput_per_second"]),
+            ("p50, мс", baseline["latency_ms"]["p50"], latency["p50"]),
+            ("p99, мс", baseline["latency_ms"]["p99"], latency["p99"]),
+            ("CPU мс/обновление", baseline["cpu_ms_per_update"], result["cpu_ms_per_update"]),
+        ):
+            change = (after - before) / before * 100 if before else 0.0
+            print(f"  {name:<20}{before:>10.2f} → {after:<10.2f}({change:+.1f}%)")
+    return 0 if result["completed"] else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    counters = subparsers.add_parser("counters", help="параллельные инкременты статистики")
+    counters.add_argument("--threads", type=int, default=16)
+    counters.add_argument("--increments", type=int, default=20000)
+    counters.add_argument("--readers", type=int, default=2)
+    counters.set_defaults(func=bench_counters)
+
+    replies = subparsers.add_parser("replies", help="стоимость подготовки ответа")
+    replies.add_argument("--iterations", type=int, default=50000)
+    replies.set_defaults(func=bench_replies)
+
+    load = subparsers.add_parser("load", help="сквозная нагрузка через имитацию Bot API")
+    load.add_argument("--updates", type=int, default=2000, help="сколько обновлений отправить")
+    load.add_argument("--chats", type=int, default=500, help="сколько разных чатов")
+    load.add_argument("--rate", type=float, default=0, help="обновлений в секунду (0 — без ограничения)")
+    load.add_argument("--latency", type=float, default=0.02, help="средняя задержка sendMessage, с")
+    load.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 500")
+    load.add_argument("--rate-limit-rate", type=float, default=0.0, help="доля ответов 429")
+    load.add_argument("--global-rate", type=float, default=100000, help="общий лимит отправки бота")
+    load.add_argument("--chat-rate", type=float, default=100000, help="лимит отправки в один чат")
+    load.add_argument("--timeout", type=float, default=120, help="сколько ждать всех ответов, с")
+    load.add_argument("--compare", action="store_true", help="сравнить с предыдущим сохранённым прогоном")
+    load.set_defaults(func=bench_load)
+
+    hll = subparsers.add_parser("hll", help="точность и память скетчей уникальных пользователей")
+    hll.add_argument("--precision", type=int, default=bot.HLL_PRECISION)
+    hll.add_argument("--trials", type=int, default=5)
+    hll.add_argument("--days", type=int, default=bot.AUDIENCE_RETENTION_DAYS)
+    hll.set_defaults(func=bench_hll)
+
+    search = subparsers.add_parser("search", help="время поиска по текстам разделов")
+    search.add_argument("--iterations", type=int, default=2000)
+    search.set_defaults(func=bench_search)
+
+    fake = subparsers.add_parser("fake-server", help="имитация Bot API")
+    fake.add_argument("--port", type=int, default=0)
+    fake.add_argument("--latency", type=float, default=0.0)
+    fake.add_argument("--error-rate", type=float, default=0.0)
+    fake.add_argument("--rate-limit-rate", type=float, default=0.0)
+    fake.add_argument("--retry-after", type=int, default=1)
+    fake.set_defaults(func=run_fake_server)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
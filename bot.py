@@ -1,235 +1,3088 @@
+import array
+import atexit
+import base64
+import bisect
+import collections
+import functools
+import gzip
+import hashlib
+import heapq
+import html
 import logging
+import math
 import os
 import time
-from flask import Flask, jsonify
+from flask import Flask, Response as FlaskResponse, jsonify, request
+import hmac
+import itertools
 import json
+import queue
+import random
+import re
+import resource
+import secrets
+import signal
+import socket
+import sqlite3
+import sys
+import tempfile
 import threading
+from concurrent.futures import Future
+from html.parser import HTMLParser
+from logging.handlers import QueueHandler, QueueListener
 import requests
+from requests.adapters import HTTPAdapter
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Настройка логирования: JSON-строки (LOG_FORMAT=text — прежний текстовый вид),
+# запись в stderr выполняет фоновый поток
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+# Одинаковые предупреждения и ошибки пишутся не чаще раза за этот интервал, с
+LOG_REPEAT_INTERVAL = float(os.environ.get('LOG_REPEAT_INTERVAL', 60))
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись: время, уровень, сообщение и поля из extra"""
+
+    FIELDS = ("chat_id", "update_id", "section", "duration_ms", "suppressed")
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage()
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    """Прежний текстовый формат с числом пропущенных повторов"""
+
+    def __init__(self):
+        super().__init__('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    def format(self, record):
+        line = super().format(record)
+        if getattr(record, "suppressed", None):
+            line += f" (пропущено повторов: {record.suppressed})"
+        return line
+
+class RepeatFilter(logging.Filter):
+    """Ограничение частоты одинаковых предупреждений и ошибок
+
+    Одинаковыми считаются записи с тем же шаблоном сообщения из той же строки
+    кода. Повтор за interval секунд отбрасывается, а число отброшенных
+    попадает в поле suppressed следующей записанной.
+    """
+
+    def __init__(self, interval=LOG_REPEAT_INTERVAL):
+        super().__init__()
+        self.interval = interval
+        self.suppressed = 0
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING or self.interval <= 0:
+            return True
+        key = (record.pathname, record.lineno, record.msg)
+        with self._lock:
+            entry = self._seen.get(key)
+            if entry is not None and record.created - entry[0] < self.interval:
+                entry[1] += 1
+                self.suppressed += 1
+                return False
+            if entry is not None and entry[1]:
+                record.suppressed = entry[1]
+            if len(self._seen) >= 1000:
+                self._seen.clear()
+            self._seen[key] = [record.created, 0]
+        return True
+
+class BoundedQueueHandler(QueueHandler):
+    """Постановка записи в ограниченную очередь без блокировки
+
+    В отличие от QueueHandler запись не форматируется в вызывающем потоке:
+    шаблон и аргументы подставляет фоновый поток. При переполненной очереди
+    запись отбрасывается и учитывается в dropped.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._drop_lock = threading.Lock()
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._drop_lock:
+                self.dropped += 1
+
+class LogListener(QueueListener):
+    """QueueListener, которому полная очередь не мешает остановиться"""
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+class LogPipeline:
+    """Логирование через очередь: потоки бота не ждут записи в stderr"""
+
+    def __init__(self, fmt=LOG_FORMAT, level=LOG_LEVEL, queue_size=LOG_QUEUE_SIZE, stream=None):
+        self.format = fmt
+        output = logging.StreamHandler(stream or sys.stderr)
+        output.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+        self.handler = BoundedQueueHandler(queue.Queue(maxsize=queue_size))
+        self.repeats = RepeatFilter()
+        self.handler.addFilter(self.repeats)
+        self.listener = LogListener(self.handler.queue, output)
+        
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+        root.setLevel(level)
+        self.listener.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Запись оставшихся сообщений и остановка фонового потока"""
+        if self.listener._thread is not None:
+            self.listener.stop()
+
+    def stats(self):
+        return {
+            "format": self.format,
+            "queue_depth": self.handler.queue.qsize(),
+            "dropped": self.handler.dropped,
+            "suppressed": self.repeats.suppressed
+        }
+
+log_pipeline = LogPipeline()
 
 logger = logging.getLogger(__name__)
 
-# Токен бота из переменных окружения Render
-BOT_TOKEN = os.environ.get('BOT_TOKEN', '')
+# Токен бота из переменных окружения Render
+BOT_TOKEN = os.environ.get('BOT_TOKEN', '')
+
+# Параметры HTTP-транспорта к Telegram Bot API
+TG_CONNECT_TIMEOUT = float(os.environ.get('TG_CONNECT_TIMEOUT', 5))
+TG_READ_TIMEOUT = float(os.environ.get('TG_READ_TIMEOUT', 10))
+TG_POLL_TIMEOUT = int(os.environ.get('TG_POLL_TIMEOUT', 30))
+TG_SEND_POOL_SIZE = int(os.environ.get('TG_SEND_POOL_SIZE', 4))
+TG_POLL_POOL_SIZE = int(os.environ.get('TG_POLL_POOL_SIZE', 1))
+TG_RETRIES = int(os.environ.get('TG_RETRIES', 2))
+
+# Long polling: какие обновления запрашивать и сколько за раз
+ALLOWED_UPDATES = ["message"]
+POLL_LIMIT = int(os.environ.get('POLL_LIMIT', 100))
+# Пауза после ошибки: от POLL_BACKOFF_BASE, удваивается до POLL_BACKOFF_MAX, с
+POLL_BACKOFF_BASE = float(os.environ.get('POLL_BACKOFF_BASE', 1))
+POLL_BACKOFF_MAX = float(os.environ.get('POLL_BACKOFF_MAX', 60))
+# Сколько ошибок подряд размыкает предохранитель и сколько без обновлений считается зависанием, с
+POLL_BREAKER_THRESHOLD = int(os.environ.get('POLL_BREAKER_THRESHOLD', 5))
+POLL_STUCK_AFTER = float(os.environ.get('POLL_STUCK_AFTER', 300))
+
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL') or os.environ.get('RENDER_EXTERNAL_URL', '')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+WEBHOOK_PATH = '/webhook'
+
+# Последний обработанный update_id и окно защиты от повторной обработки
+OFFSET_FILE = "bot_offset.json"
+DEDUP_WINDOW = int(os.environ.get('DEDUP_WINDOW', 1000))
+# Сколько в сумме ждать завершения начатой работы при остановке, с
+SHUTDOWN_TIMEOUT = float(os.environ.get('SHUTDOWN_TIMEOUT', 20))
+
+# Параметры параллельной обработки обновлений
+DISPATCH_WORKERS = int(os.environ.get('DISPATCH_WORKERS', 4))
+DISPATCH_QUEUE_SIZE = int(os.environ.get('DISPATCH_QUEUE_SIZE', 50))
+
+# HTTP-сервер: кэш /stats, сжатие ответов и необязательный production WSGI-сервер
+STATS_CACHE_TTL = float(os.environ.get('STATS_CACHE_TTL', 2))
+GZIP_MIN_SIZE = int(os.environ.get('GZIP_MIN_SIZE', 500))
+GZIP_LEVEL = 6
+GZIP_MIMETYPES = {"text/html", "text/css", "text/plain", "application/json"}
+WSGI_SERVER = os.environ.get('WSGI_SERVER', '')
+WSGI_THREADS = int(os.environ.get('WSGI_THREADS', 8))
+
+# Внешний файл (или каталог с content.json) с текстами разделов и меню
+CONTENT_PATH = os.environ.get('CONTENT_PATH', '')
+CONTENT_CHECK_INTERVAL = float(os.environ.get('CONTENT_CHECK_INTERVAL', 5))
+
+# Размер кэша результатов поиска по текстам разделов (число разных запросов)
+SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE', 1024))
+
+# Вложения разделов: file_id загруженных в Telegram файлов по хэшу содержимого
+MEDIA_CACHE_FILE = "bot_media.json"
+
+# Подписчики и рассылка новостей
+SUBSCRIBERS_FILE = "bot_subscribers.bin"
+BROADCAST_STATE_FILE = "bot_broadcast.json"
+BROADCAST_BATCH = int(os.environ.get('BROADCAST_BATCH', 100))
+# Рассылка занимает не весь общий лимит, чтобы оставалось место для ответов
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', 20))
+# Администраторы (chat_id через запятую) и токен для HTTP-рассылки
+ADMIN_IDS = {int(chat_id) for chat_id in os.environ.get('ADMIN_IDS', '').split(',') if chat_id.strip()}
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+# Лимиты исходящих сообщений: Telegram допускает около 30 сообщений в секунду
+# всего и около одного в секунду в одном чате
+SEND_GLOBAL_RATE = float(os.environ.get('SEND_GLOBAL_RATE', 30))
+SEND_CHAT_RATE = float(os.environ.get('SEND_CHAT_RATE', 1))
+SEND_CHAT_BURST = int(os.environ.get('SEND_CHAT_BURST', 3))
+SEND_WORKERS = int(os.environ.get('SEND_WORKERS', 4))
+SEND_QUEUE_SIZE = int(os.environ.get('SEND_QUEUE_SIZE', 1000))
+SEND_ENQUEUE_TIMEOUT = float(os.environ.get('SEND_ENQUEUE_TIMEOUT', 5))
+SEND_MAX_RETRIES = int(os.environ.get('SEND_MAX_RETRIES', 3))
+SEND_RETRY_BACKOFF = float(os.environ.get('SEND_RETRY_BACKOFF', 0.5))
+# 429 в повторы 5xx не входит: запрос ждёт retry_after, пока с постановки не прошло столько секунд
+SEND_RATE_LIMIT_DEADLINE = float(os.environ.get('SEND_RATE_LIMIT_DEADLINE', 300))
+
+# Файл для хранения статистики
+STATS_FILE = "bot_stats.json"
+
+# Отложенная запись статистики: раз в интервал, по порогу изменений и при остановке
+STATS_FLUSH_INTERVAL = float(os.environ.get('STATS_FLUSH_INTERVAL', 10))
+STATS_FLUSH_THRESHOLD = int(os.environ.get('STATS_FLUSH_THRESHOLD', 100))
+# Необязательный журнал приращений; полный снимок пишется раз в STATS_COMPACT_EVERY сбросов
+STATS_DELTA_LOG = os.environ.get('STATS_DELTA_LOG', '')
+STATS_COMPACT_EVERY = int(os.environ.get('STATS_COMPACT_EVERY', 30))
+
+# Уникальные пользователи: скетчи HyperLogLog по разделам и дням.
+# Скетч занимает 2**HLL_PRECISION байт, ошибка оценки около 1.04 / sqrt(2**HLL_PRECISION)
+AUDIENCE_DIR = "bot_audience"
+HLL_PRECISION = int(os.environ.get('HLL_PRECISION', 11))
+AUDIENCE_RETENTION_DAYS = int(os.environ.get('AUDIENCE_RETENTION_DAYS', 60))
+
+# Несколько экземпляров: общая база SQLite на общем томе (пусто — один экземпляр).
+# getUpdates вызывает только держатель аренды; срок аренды должен быть больше
+# длительности long polling, свободную аренду остальные проверяют раз в LEASE_RETRY_INTERVAL
+SHARED_DB = os.environ.get('SHARED_DB', '')
+INSTANCE_ID = (os.environ.get('INSTANCE_ID') or os.environ.get('RENDER_INSTANCE_ID')
+               or f"{socket.gethostname()}-{os.getpid()}")
+LEASE_TTL = float(os.environ.get('LEASE_TTL', 90))
+LEASE_RETRY_INTERVAL = float(os.environ.get('LEASE_RETRY_INTERVAL', 5))
+
+# Статистика по времени: буферы пишутся на диск не чаще раза в интервал
+TIMESERIES_FILE = "bot_timeseries.bin"
+TIMESERIES_FLUSH_INTERVAL = float(os.environ.get('TIMESERIES_FLUSH_INTERVAL', 60))
+# Смещение местного времени от UTC для «сегодня» и «вчера» (Санкт-Петербург — UTC+3)
+STATS_TZ_OFFSET = float(os.environ.get('STATS_TZ_OFFSET', 3))
+
+def atomic_write(path, data):
+    """Атомарная запись файла: временный файл в том же каталоге и rename"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return len(data)
+
+def remaining(deadline):
+    """Секунды до deadline по time.monotonic(), не меньше нуля; None — без ограничения"""
+    return None if deadline is None else max(deadline - time.monotonic(), 0.0)
+
+class StripedCounters:
+    """Набор счётчиков с отдельной копией на каждый поток
+
+    Поток увеличивает только свою копию, поэтому инкремент не берёт
+    блокировок и не конкурирует с другими потоками; при чтении копии всех
+    потоков суммируются. Сброс запоминает текущие суммы как базу и не
+    трогает копии потоков, поэтому параллельные инкременты не теряются.
+    """
+
+    def __init__(self, initial=None):
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+        self._reset_lock = threading.Lock()
+        self._base = dict(initial or {})
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = {}
+            with self._shards_lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+            return shard
+
+    def add(self, key, amount=1):
+        """Увеличение счётчика в копии текущего потока"""
+        shard = self._shard()
+        shard[key] = shard.get(key, 0) + amount
+
+    def _totals(self):
+        with self._shards_lock:
+            shards = list(self._shards)
+        totals = {}
+        for shard in shards:
+            # dict.copy() выполняется целиком под GIL, поэтому безопасен
+            # даже если владелец копии в этот момент добавляет ключ
+            for key, value in shard.copy().items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def snapshot(self):
+        """Согласованная копия всех счётчиков"""
+        # База читается раньше сумм: при параллельном сбросе получим
+        # значения до сброса, но не отрицательные
+        base = self._base
+        totals = self._totals()
+        result = dict(base)
+        for key, value in totals.items():
+            result[key] = result.get(key, 0) + value
+        return result
+
+    def reset(self, keys=()):
+        """Атомарное обнуление всех счётчиков"""
+        with self._reset_lock:
+            totals = self._totals()
+            base = {key: 0 for key in keys}
+            base.update({key: -value for key, value in totals.items()})
+            self._base = base
+
+class Histogram:
+    """Гистограмма с фиксированными границами в формате Prometheus
+
+    Как и StripedCounters, каждый поток пишет в свой список счётчиков, так
+    что observe() не берёт блокировок; списки суммируются при выгрузке.
+    """
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+
+    def observe(self, value):
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            # Счётчики по корзинам, затем корзина +Inf и сумма значений
+            shard = self._local.shard = [0] * (len(self.buckets) + 1) + [0.0]
+            with self._shards_lock:
+                self._shards.append(shard)
+        shard[bisect.bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    def render(self):
+        with self._shards_lock:
+            shards = [list(shard) for shard in self._shards]
+        totals = [sum(column) for column in zip(*shards)] or [0] * (len(self.buckets) + 2)
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), totals):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {totals[-1]}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+class BotMetrics:
+    """Метрики горячих путей бота для /metrics"""
+
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    LAG_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 300, 3600)
+    BATCH_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+    SEARCH_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01)
+
+    def __init__(self):
+        self.get_updates = Histogram("bot_get_updates_seconds",
+                                     "Duration of getUpdates calls", self.LATENCY_BUCKETS)
+        self.process_update = Histogram("bot_process_update_seconds",
+                                        "Time to handle one update", self.LATENCY_BUCKETS)
+        self.send_message = Histogram("bot_send_seconds",
+                                      "Duration of outgoing Bot API requests", self.LATENCY_BUCKETS)
+        self.update_lag = Histogram("bot_update_lag_seconds",
+                                    "Delay between message date and handling", self.LAG_BUCKETS)
+        self.updates_per_batch = Histogram("bot_updates_per_batch",
+                                           "Updates returned by one getUpdates call", self.BATCH_BUCKETS)
+        self.search = Histogram("bot_search_seconds",
+                                "Free-text search over section texts", self.SEARCH_BUCKETS)
+        self.api_errors = StripedCounters()
+        self.search_results = StripedCounters({"found": 0, "not_found": 0})
+
+    def histograms(self):
+        return [self.get_updates, self.process_update, self.send_message,
+                self.update_lag, self.updates_per_batch, self.search]
+
+    def render(self, gauges=(), counters=()):
+        """Все метрики в текстовом формате Prometheus
+
+        gauges и counters — дополнительные значения (имя, описание, значение);
+        counters только растут (или обнуляются при сбросе), и к ним применим rate().
+        """
+        lines = []
+        for histogram in self.histograms():
+            lines.extend(histogram.render())
+        lines.append("# HELP bot_api_errors_total Bot API error responses by error_code")
+        lines.append("# TYPE bot_api_errors_total counter")
+        for code, count in sorted(self.api_errors.snapshot().items()):
+            lines.append(f'bot_api_errors_total{{error_code="{code}"}} {count}')
+        lines.append("# HELP bot_search_queries_total Free-text search queries by outcome")
+        lines.append("# TYPE bot_search_queries_total counter")
+        for outcome, count in sorted(self.search_results.snapshot().items()):
+            lines.append(f'bot_search_queries_total{{result="{outcome}"}} {count}')
+        for kind, metrics in (("counter", counters), ("gauge", gauges)):
+            for name, help_text, value in metrics:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+def resident_memory_bytes():
+    """RSS процесса: из /proc на Linux, иначе пиковое значение из getrusage"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+bot_metrics = BotMetrics()
+
+class SubscriberRegistry:
+    """Множество chat_id, запускавших бота
+
+    На диске — массив 64-битных chat_id: новый подписчик дописывается в
+    конец файла (8 байт), при загрузке дубликаты и недописанный хвост
+    убираются, а файл переписывается целиком.
+    """
+
+    def __init__(self, path=SUBSCRIBERS_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._ids = set()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        ids = array.array('q')
+        ids.frombytes(data[:len(data) - len(data) % ids.itemsize])
+        self._ids = set(ids)
+        if len(self._ids) * ids.itemsize != len(data):
+            self._rewrite()
+
+    def _rewrite(self):
+        atomic_write(self.path, array.array('q', sorted(self._ids)).tobytes())
+
+    def add(self, chat_id):
+        """Запоминает чат; возвращает True, если он новый"""
+        # Быстрый путь без блокировки: проверка вхождения в set атомарна
+        if chat_id in self._ids:
+            return False
+        with self._lock:
+            if chat_id in self._ids:
+                return False
+            self._ids.add(chat_id)
+            try:
+                with open(self.path, 'ab') as f:
+                    f.write(array.array('q', [chat_id]).tobytes())
+            except Exception as e:
+                logger.error("Ошибка сохранения подписчика %s: %s", chat_id, e, extra={"chat_id": chat_id})
+            return True
+
+    def remove_many(self, chat_ids):
+        """Удаление чатов (например, заблокировавших бота)"""
+        if not chat_ids:
+            return
+        with self._lock:
+            self._ids.difference_update(chat_ids)
+            self._rewrite()
+
+    def snapshot(self):
+        """Отсортированный список chat_id"""
+        with self._lock:
+            return sorted(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+class RingSeries:
+    """Счётчики разделов по интервалам времени в кольцевом буфере
+
+    Под slots интервалов по step секунд память выделяется один раз: на каждый
+    интервал — строка счётчиков по всем ключам и номер интервала, который в
+    ней сейчас лежит. Устаревшая строка обнуляется при первой записи в неё.
+    """
+
+    def __init__(self, step, slots, keys):
+        self.step = step
+        self.slots = slots
+        self.keys = list(keys)
+        self.index = {key: i for i, key in enumerate(self.keys)}
+        self.counts = array.array('I', [0]) * (slots * len(self.keys))
+        self.intervals = array.array('q', [-1]) * slots
+        self._lock = threading.Lock()
+
+    def add(self, key, timestamp, amount=1):
+        column = self.index.get(key)
+        if column is None:
+            return
+        interval = int(timestamp // self.step)
+        slot = interval % self.slots
+        width = len(self.keys)
+        with self._lock:
+            if self.intervals[slot] != interval:
+                self.counts[slot * width:(slot + 1) * width] = array.array('I', [0]) * width
+                self.intervals[slot] = interval
+            self.counts[slot * width + column] += amount
+
+    def series(self, start, end):
+        """Список (начало интервала, {ключ: число}) для интервалов в [start, end)"""
+        last = int((end - 1) // self.step)
+        first = max(int(start // self.step), last - self.slots + 1)
+        width = len(self.keys)
+        result = []
+        with self._lock:
+            for interval in range(first, last + 1):
+                slot = interval % self.slots
+                if self.intervals[slot] == interval:
+                    row = self.counts[slot * width:(slot + 1) * width]
+                    result.append((interval * self.step, dict(zip(self.keys, row))))
+                else:
+                    result.append((interval * self.step, dict.fromkeys(self.keys, 0)))
+        return result
+
+    def dump(self):
+        with self._lock:
+            return self.intervals.tobytes() + self.counts.tobytes()
+
+    def restore(self, data, keys):
+        """Загрузка из dump(); столбцы сопоставляются по именам ключей"""
+        old_width = len(keys)
+        intervals = array.array('q')
+        intervals.frombytes(data[:8 * self.slots])
+        counts = array.array('I')
+        counts.frombytes(data[8 * self.slots:8 * self.slots + 4 * self.slots * old_width])
+        width = len(self.keys)
+        with self._lock:
+            self.intervals = intervals
+            for old_column, key in enumerate(keys):
+                column = self.index.get(key)
+                if column is None:
+                    continue
+                for slot in range(self.slots):
+                    self.counts[slot * width + column] = counts[slot * old_width + old_column]
+
+class TimeSeries:
+    """Поминутная статистика за сутки и почасовая за 90 дней"""
+
+    GRANULARITIES = {"minute": (60, 24 * 60), "hour": (3600, 90 * 24)}
+
+    def __init__(self, keys, path=TIMESERIES_FILE):
+        self.path = path
+        self.keys = list(keys)
+        self.rings = {name: RingSeries(step, slots, self.keys)
+                      for name, (step, slots) in self.GRANULARITIES.items()}
+        self.dirty = False
+        self._load()
+
+    def set_keys(self, keys):
+        """Смена набора ключей с переносом истории совпадающих"""
+        old_keys = self.keys
+        rings = {}
+        for name, ring in self.rings.items():
+            new_ring = RingSeries(ring.step, ring.slots, keys)
+            new_ring.restore(ring.dump(), old_keys)
+            rings[name] = new_ring
+        self.keys = list(keys)
+        self.rings = rings
+        self.dirty = True
+
+    def add(self, key, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        for ring in self.rings.values():
+            ring.add(key, timestamp)
+        self.dirty = True
+
+    def series(self, granularity, window):
+        """Точки за последние window секунд с шагом granularity"""
+        now = time.time()
+        return self.rings[granularity].series(now - window, now)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                header = json.loads(f.readline())
+                for name, step, slots in header["rings"]:
+                    ring = self.rings.get(name)
+                    size = slots * (8 + 4 * len(header["keys"]))
+                    data = f.read(size)
+                    if ring is not None and (ring.step, ring.slots) == (step, slots) and len(data) == size:
+                        ring.restore(data, header["keys"])
+        except Exception as e:
+            logger.error("Ошибка загрузки почасовой статистики: %s", e)
+
+    def save(self):
+        """Атомарная запись всех буферов; возвращает число записанных байт"""
+        self.dirty = False
+        rings = [[name, ring.step, ring.slots] for name, ring in self.rings.items()]
+        header = json.dumps({"keys": self.keys, "rings": rings}, ensure_ascii=False) + "\n"
+        data = header.encode('utf-8') + b"".join(ring.dump() for ring in self.rings.values())
+        return atomic_write(self.path, data)
+
+class HyperLogLog:
+    """Оценка числа различных значений в фиксированной памяти (HyperLogLog)
+
+    Скетч — 2**precision однобайтовых регистров; стандартная ошибка оценки
+    1.04 / sqrt(2**precision), при precision=11 это 2 КиБ и около 2.3 %.
+    Скетчи одинаковой точности объединяются поэлементным максимумом, и
+    объединение оценивает число различных значений во всех исходных скетчах.
+    """
+
+    __slots__ = ("precision", "registers")
+
+    # 2 ** -r для всех возможных значений регистра
+    _POWERS = [2.0 ** -rank for rank in range(65)]
+
+    def __init__(self, precision=HLL_PRECISION, registers=None):
+        self.precision = precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(1 << precision)
+
+    @staticmethod
+    def hash(value):
+        """64-битный хэш значения (одинаковый во всех процессах, в отличие от hash())"""
+        return int.from_bytes(hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest(), 'big')
+
+    def add_hash(self, hashed):
+        """Учёт значения по его хэшу; True, если скетч изменился"""
+        bits = 64 - self.precision
+        index = hashed >> bits
+        rank = bits - (hashed & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+
+    def add(self, value):
+        return self.add_hash(self.hash(value))
+
+    def merge(self, other):
+        """Объединение с другим скетчем; True, если скетч изменился"""
+        merged = bytearray(map(max, self.registers, other.registers))
+        changed = merged != self.registers
+        self.registers = merged
+        return changed
+
+    @classmethod
+    def union(cls, sketches, precision=HLL_PRECISION):
+        """Новый скетч — объединение нескольких"""
+        sketches = list(sketches)
+        if len(sketches) == 1:
+            return cls(precision, sketches[0].registers)
+        if not sketches:
+            return cls(precision)
+        return cls(precision, map(max, *(sketch.registers for sketch in sketches)))
+
+    def count(self):
+        """Оценка числа различных значений"""
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(map(self._POWERS.__getitem__, self.registers))
+        zeros = self.registers.count(0)
+        # Для малых чисел точнее линейный подсчёт по пустым регистрам
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+class AudienceStore:
+    """Уникальные пользователи по разделам и дням на скетчах HyperLogLog
+
+    На каждый день (по местному времени) и раздел заводится свой скетч, а
+    общий скетч дня хранится под ключом ALL. Уникальные за несколько дней
+    считаются объединением дневных скетчей. Каждый день хранится в
+    отдельном файле каталога path, на диск пишутся только изменившиеся дни,
+    а дни старше retention_days удаляются. Память ограничена:
+    (разделов + 1) × retention_days × 2**precision байт.
+    """
+
+    ALL = "*"
+
+    def __init__(self, path=AUDIENCE_DIR, precision=HLL_PRECISION,
+                 retention_days=AUDIENCE_RETENTION_DAYS):
+        self.path = path
+        self.precision = precision
+        self.retention_days = retention_days
+        self.days = {}
+        self._lock = threading.Lock()
+        # Дни для записи на диск и скетчи для отправки в общую базу
+        self._dirty_days = set()
+        self._unsynced = set()
+        self._synced_at = 0.0
+        self._load()
+
+    @staticmethod
+    def day_of(timestamp):
+        """Номер дня по местному времени"""
+        return int((timestamp + STATS_TZ_OFFSET * 3600) // 86400)
+
+    @property
+    def dirty(self):
+        return bool(self._dirty_days)
+
+    def _load(self):
+        if not os.path.isdir(self.path):
+            return
+        oldest = self.day_of(time.time()) - self.retention_days + 1
+        for name in os.listdir(self.path):
+            day, ext = os.path.splitext(name)
+            if ext != ".json" or not day.isdigit():
+                continue
+            if int(day) < oldest:
+                os.remove(os.path.join(self.path, name))
+                continue
+            try:
+                with open(os.path.join(self.path, name), 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data["precision"] != self.precision:
+                    logger.warning("Скетчи %s сохранены с точностью %s, пропущены", name, data["precision"])
+                    continue
+                sketches = {key: HyperLogLog(self.precision, base64.b64decode(registers))
+                            for key, registers in data["sketches"].items()}
+                # Обрезанный файл испортил бы объединение: union сокращает скетчи до кратчайшего
+                broken = [key for key, sketch in sketches.items()
+                          if len(sketch.registers) != 1 << self.precision]
+                if broken:
+                    logger.warning("Скетчи %s повреждены (неверная длина регистров: %s), пропущены",
+                                   name, ", ".join(broken))
+                    continue
+                self.days[int(day)] = sketches
+            except Exception as e:
+                logger.error("Ошибка загрузки скетчей %s: %s", name, e)
+
+    def _prune(self, today):
+        oldest = today - self.retention_days + 1
+        for day in [day for day in self.days if day < oldest]:
+            del self.days[day]
+            self._dirty_days.discard(day)
+            try:
+                os.remove(os.path.join(self.path, f"{day}.json"))
+            except OSError:
+                pass
+
+    def add(self, section, chat_id, now=None):
+        """Учёт пользователя в разделе и в общем скетче дня"""
+        hashed = HyperLogLog.hash(chat_id)
+        day = self.day_of(time.time() if now is None else now)
+        with self._lock:
+            sketches = self.days.get(day)
+            if sketches is None:
+                sketches = self.days[day] = {}
+                self._prune(day)
+            for key in (section, self.ALL):
+                sketch = sketches.get(key)
+                if sketch is None:
+                    sketch = sketches[key] = HyperLogLog(self.precision)
+                if sketch.add_hash(hashed):
+                    self._dirty_days.add(day)
+                    self._unsynced.add((day, key))
+
+    def unique(self, days=1, now=None):
+        """Оценка уникальных пользователей по разделам за последние days дней"""
+        today = self.day_of(time.time() if now is None else now)
+        with self._lock:
+            by_key = {}
+            for day in range(today - days + 1, today + 1):
+                for key, sketch in self.days.get(day, {}).items():
+                    by_key.setdefault(key, []).append(sketch)
+            merged = {key: HyperLogLog.union(sketches, self.precision) for key, sketches in by_key.items()}
+        return {key: sketch.count() for key, sketch in merged.items()}
+
+    def save(self):
+        """Запись изменившихся дней; возвращает число записанных байт"""
+        with self._lock:
+            dirty = {day: {key: bytes(sketch.registers) for key, sketch in self.days[day].items()}
+                     for day in self._dirty_days if day in self.days}
+            self._dirty_days = set()
+        written = 0
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            for day, sketches in dirty.items():
+                data = json.dumps({
+                    "precision": self.precision,
+                    "sketches": {key: base64.b64encode(registers).decode('ascii')
+                                 for key, registers in sketches.items()}
+                }, ensure_ascii=False).encode('utf-8')
+                written += atomic_write(os.path.join(self.path, f"{day}.json"), data)
+        except Exception:
+            with self._lock:
+                self._dirty_days.update(dirty)
+            raise
+        return written
+
+    def sync(self, shared):
+        """Обмен скетчами с общей базой: свои изменения туда, чужие — сюда"""
+        oldest = self.day_of(time.time()) - self.retention_days + 1
+        with self._lock:
+            changed = {(day, key): bytes(self.days[day][key].registers)
+                       for day, key in self._unsynced if day in self.days}
+            self._unsynced = set()
+        try:
+            rows, synced_at = shared.sync_sketches(changed, self._synced_at, oldest)
+        except Exception:
+            with self._lock:
+                self._unsynced.update(changed)
+            raise
+        with self._lock:
+            for (day, key), registers in rows.items():
+                if day < oldest or len(registers) != 1 << self.precision:
+                    continue
+                sketches = self.days.setdefault(day, {})
+                if key not in sketches:
+                    sketches[key] = HyperLogLog(self.precision, registers)
+                    self._dirty_days.add(day)
+                elif sketches[key].merge(HyperLogLog(self.precision, registers)):
+                    self._dirty_days.add(day)
+        # Запас на транзакции других экземпляров, начатые чуть раньше
+        self._synced_at = synced_at - 5
+
+    def stats(self, now=None):
+        """Уникальные за сегодня, 7 и 30 дней и расход памяти для /stats"""
+        sketch_bytes = 1 << self.precision
+        with self._lock:
+            sketches = sum(len(day) for day in self.days.values())
+        return {
+            "precision": self.precision,
+            "sketch_bytes": sketch_bytes,
+            "standard_error": round(1.04 / math.sqrt(sketch_bytes), 4),
+            "sketches": sketches,
+            "memory_bytes": sketches * sketch_bytes,
+            "days_stored": len(self.days),
+            "retention_days": self.retention_days,
+            "unique": {f"{days}d": self.unique(days, now) for days in (1, 7, 30)}
+        }
+
+class SharedState:
+    """Общее состояние нескольких экземпляров бота в SQLite (режим WAL)
+
+    Счётчики разделов хранятся в одной таблице: каждый экземпляр пачкой
+    прибавляет свои приращения и в той же транзакции получает общие итоги.
+    Таблица аренд выбирает единственный экземпляр для getUpdates: аренда
+    продлевается перед каждым запросом, а если держатель перестал её
+    продлевать, после истечения срока её забирает другой экземпляр. В аренде
+    хранится и последний подтверждённый update_id, чтобы новый держатель не
+    обрабатывал заново уже разобранные обновления. В таблице settings лежат
+    значения, которые должны совпадать у всех экземпляров, например секрет webhook.
+
+    WAL требует общей памяти, поэтому база должна лежать на томе,
+    подключённом к экземплярам на одном хосте, а не на сетевой файловой системе.
+    """
+
+    def __init__(self, path, busy_timeout=5.0):
+        self.path = path
+        self._lock = threading.Lock()
+        # Транзакции открываются явно (BEGIN IMMEDIATE), поэтому autocommit
+        self._db = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS button_stats "
+                         "(key TEXT PRIMARY KEY, count INTEGER NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS leases "
+                         "(name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires REAL NOT NULL, "
+                         "update_offset INTEGER NOT NULL DEFAULT 0)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS audience "
+                         "(day INTEGER NOT NULL, section TEXT NOT NULL, registers BLOB NOT NULL, "
+                         "updated REAL NOT NULL, PRIMARY KEY (day, section))")
+        self._db.execute("CREATE TABLE IF NOT EXISTS settings "
+                         "(name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.metrics = {"syncs": 0, "errors": 0, "last_sync_ms": 0.0}
+
+    def _write(self, apply):
+        """Выполнение apply(db) в одной пишущей транзакции"""
+        started = time.perf_counter()
+        with self._lock:
+            try:
+                self._db.execute("BEGIN IMMEDIATE")
+                try:
+                    result = apply(self._db)
+                except BaseException:
+                    self._db.execute("ROLLBACK")
+                    raise
+                self._db.execute("COMMIT")
+            except sqlite3.Error:
+                self.metrics["errors"] += 1
+                raise
+            self.metrics["syncs"] += 1
+            self.metrics["last_sync_ms"] = (time.perf_counter() - started) * 1000
+            return result
+
+    def sync_counts(self, delta, reset=False):
+        """Прибавление приращений экземпляра; возвращает общие счётчики
+
+        При reset общие счётчики сначала обнуляются, а delta — это значения
+        экземпляра, накопленные после сброса.
+        """
+        def apply(db):
+            if reset:
+                db.execute("UPDATE button_stats SET count = 0")
+            db.executemany("INSERT INTO button_stats (key, count) VALUES (?, ?) "
+                           "ON CONFLICT(key) DO UPDATE SET count = count + excluded.count",
+                           delta.items())
+            return dict(db.execute("SELECT key, count FROM button_stats"))
+        return self._write(apply)
+
+    def seed_counts(self, counts):
+        """Перенос счётчиков из bot_stats.json, если общая таблица ещё пуста"""
+        def apply(db):
+            if db.execute("SELECT 1 FROM button_stats LIMIT 1").fetchone() is None:
+                db.executemany("INSERT INTO button_stats (key, count) VALUES (?, ?)", counts.items())
+            return dict(db.execute("SELECT key, count FROM button_stats"))
+        return self._write(apply)
+
+    def sync_sketches(self, changed, since, oldest_day):
+        """Объединение своих скетчей с общими и чтение изменённых с момента since
+
+        changed — {(день, раздел): регистры}. Возвращает скетчи, изменённые
+        после since (включая только что записанные), и время этой транзакции.
+        """
+        def apply(db):
+            now = time.time()
+            for (day, section), registers in changed.items():
+                row = db.execute("SELECT registers FROM audience WHERE day = ? AND section = ?",
+                                 (day, section)).fetchone()
+                if row is not None and len(row[0]) == len(registers):
+                    registers = bytes(map(max, registers, row[0]))
+                db.execute("INSERT OR REPLACE INTO audience (day, section, registers, updated) "
+                           "VALUES (?, ?, ?, ?)", (day, section, registers, now))
+            db.execute("DELETE FROM audience WHERE day < ?", (oldest_day,))
+            rows = db.execute("SELECT day, section, registers FROM audience WHERE updated >= ?", (since,))
+            return {(day, section): registers for day, section, registers in rows}, now
+        return self._write(apply)
+
+    def setting(self, name, default):
+        """Общее значение настройки; первый спросивший экземпляр записывает default"""
+        def apply(db):
+            db.execute("INSERT OR IGNORE INTO settings (name, value) VALUES (?, ?)", (name, default))
+            return db.execute("SELECT value FROM settings WHERE name = ?", (name,)).fetchone()[0]
+        return self._write(apply)
+
+    def acquire_lease(self, name, holder, ttl, offset=0):
+        """Захват или продление аренды
+
+        Возвращает последний update_id из аренды (не меньше offset) или None,
+        если аренда действует и принадлежит другому экземпляру.
+        """
+        def apply(db):
+            now = time.time()
+            row = db.execute("SELECT holder, expires, update_offset FROM leases WHERE name = ?",
+                             (name,)).fetchone()
+            if row is not None and row[0] != holder and row[1] > now:
+                return None
+            update_offset = max(offset, row[2] if row is not None else 0)
+            db.execute("INSERT INTO leases (name, holder, expires, update_offset) VALUES (?, ?, ?, ?) "
+                       "ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, "
+                       "expires = excluded.expires, update_offset = excluded.update_offset",
+                       (name, holder, now + ttl, update_offset))
+            return update_offset
+        return self._write(apply)
+
+    def release_lease(self, name, holder, offset=0):
+        """Досрочное освобождение аренды при остановке"""
+        self._write(lambda db: db.execute(
+            "UPDATE leases SET expires = 0, update_offset = MAX(update_offset, ?) "
+            "WHERE name = ? AND holder = ?", (offset, name, holder)))
+
+    def lease_holder(self, name):
+        """Текущий держатель аренды или None"""
+        with self._lock:
+            row = self._db.execute("SELECT holder, expires FROM leases WHERE name = ?",
+                                   (name,)).fetchone()
+        if row is None or row[1] <= time.time():
+            return None
+        return row[0]
+
+    def stats(self):
+        return dict(self.metrics, path=self.path)
+
+shared_state = SharedState(SHARED_DB) if SHARED_DB else None
+
+class StatsStore:
+    """Счётчики обращений в памяти с отложенной записью на диск
+
+    Обработчики только увеличивают счётчики в памяти, а фоновый поток
+    сбрасывает накопленные изменения одной записью. Снимок пишется атомарно,
+    поэтому сбой во время записи не портит файл. Если задан журнал
+    приращений, между снимками в него дописываются только изменения, а при
+    загрузке журнал применяется к снимку и сворачивается.
+
+    С общей базой (shared) изменения вместо файла прибавляются к общим
+    счётчикам, и локальные счётчики сдвигаются к общим итогам, так что все
+    экземпляры показывают одинаковые числа с задержкой не больше интервала сброса.
+    """
+
+    def __init__(self, path=STATS_FILE, delta_log=STATS_DELTA_LOG,
+                 flush_interval=STATS_FLUSH_INTERVAL, flush_threshold=STATS_FLUSH_THRESHOLD,
+                 compact_every=STATS_COMPACT_EVERY, shared=None):
+        self.path = path
+        self.shared = shared
+        self.delta_log = delta_log
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.compact_every = compact_every
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        # next() у itertools.count атомарен, поэтому подходит как счётчик операций
+        self._ops = itertools.count(1)
+        self._needs_snapshot = False
+        self._reset_shared = False
+        self._seq = 0
+        self._flushes_since_snapshot = 0
+        self.metrics = {
+            "flushes": 0,
+            "snapshots": 0,
+            "errors": 0,
+            "bytes_written": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "total_flush_ms": 0.0
+        }
+        self._flushed = self._load()
+        if shared is not None:
+            try:
+                self._flushed = {**self._flushed, **shared.seed_counts(self._flushed)}
+            except sqlite3.Error as e:
+                logger.error("Ошибка чтения общей статистики: %s", e)
+        self._counters = StripedCounters(self._flushed)
+        self.timeseries = TimeSeries(DEFAULT_STATS)
+        self._timeseries_saved_at = time.monotonic()
+        self.audience = AudienceStore()
+        self._audience_saved_at = time.monotonic()
+
+    def _load(self):
+        """Загрузка снимка и применение журнала приращений"""
+        counts = dict(DEFAULT_STATS)
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                # Старый формат файла — просто словарь счётчиков
+                stats = data.get("button_stats", data)
+                if "📚 История" in stats:
+                    stats["📚 История кафедры"] = stats.pop("📚 История")
+                counts.update(stats)
+                self._seq = data.get("delta_seq", 0)
+        except Exception as e:
+            logger.error("Ошибка загрузки статистики: %s", e)
+            # Не затираем повреждённый файл — он может пригодиться для восстановления
+            try:
+                os.replace(self.path, f"{self.path}.corrupt-{int(time.time())}")
+            except OSError:
+                pass
+        
+        replayed = 0
+        if self.delta_log and os.path.exists(self.delta_log):
+            with open(self.delta_log, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Недописанная последняя строка после сбоя
+                        break
+                    if record["seq"] <= self._seq:
+                        continue
+                    for key, value in record["delta"].items():
+                        counts[key] = counts.get(key, 0) + value
+                    self._seq = record["seq"]
+                    replayed += 1
+        if replayed:
+            logger.info("Применено %d записей журнала статистики", replayed)
+            self._write_snapshot(counts)
+        return counts
+
+    def increment(self, key, amount=1, chat_id=None):
+        """Увеличение счётчика без обращения к диску; chat_id учитывается в уникальных"""
+        self._counters.add(key, amount)
+        self.timeseries.add(key)
+        if chat_id is not None:
+            self.audience.add(key, chat_id)
+        if next(self._ops) % self.flush_threshold == 0:
+            self._wake.set()
+
+    def snapshot(self):
+        """Копия текущих счётчиков"""
+        return self._counters.snapshot()
+
+    def track(self, keys):
+        """Учёт нового набора разделов после перезагрузки текстов"""
+        counts = self.snapshot()
+        for key in keys:
+            if key not in counts:
+                self._counters.add(key, 0)
+        if list(keys) != self.timeseries.keys:
+            self.timeseries.set_keys(keys)
+
+    def reset(self):
+        """Обнуление счётчиков; сбрасывается на диск полным снимком"""
+        self._counters.reset(self.snapshot())
+        self._needs_snapshot = True
+        self._reset_shared = self.shared is not None
+        self._wake.set()
+
+    def _pending_delta(self, counts):
+        """Изменения относительно последнего сброса на диск"""
+        delta = {}
+        for key in counts.keys() | self._flushed.keys():
+            change = counts.get(key, 0) - self._flushed.get(key, 0)
+            if change:
+                delta[key] = change
+        return delta
+
+    def start(self):
+        """Запуск фонового потока записи"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="stats-flusher", daemon=True)
+            self._thread.start()
+
+    def close(self):
+        """Остановка фонового потока и финальный сброс"""
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush(snapshot=True)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self, snapshot=False):
+        """Сброс накопленных изменений одной записью"""
+        with self._flush_lock:
+            snapshot = snapshot or self._needs_snapshot
+            self._needs_snapshot = False
+            counts = self.snapshot()
+            # Приращение считается разностью снимков, поэтому верно и после сброса
+            delta = self._pending_delta(counts)
+            save_timeseries = self.timeseries.dirty and (
+                snapshot or time.monotonic() - self._timeseries_saved_at >= TIMESERIES_FLUSH_INTERVAL)
+            # Скетчи пишутся с интервалом статистики по времени, а с общей базой
+            # обмениваются и без своих изменений
+            save_audience = (self.audience.dirty or self.shared is not None) and (
+                snapshot or time.monotonic() - self._audience_saved_at >= TIMESERIES_FLUSH_INTERVAL)
+            # С общей базой сброс нужен и без своих изменений — чтобы получить чужие
+            if not (delta or snapshot or save_timeseries or save_audience or self.shared is not None):
+                return
+            snapshot = snapshot or not self.delta_log
+            
+            started = time.perf_counter()
+            try:
+                written = 0
+                if self.shared is not None:
+                    self._sync_shared(counts, delta)
+                elif snapshot or self._flushes_since_snapshot + 1 >= self.compact_every:
+                    written += self._write_snapshot(counts)
+                elif delta:
+                    written += self._append_delta(delta)
+                if save_timeseries:
+                    written += self.timeseries.save()
+                    self._timeseries_saved_at = time.monotonic()
+                if save_audience:
+                    if self.shared is not None:
+                        self.audience.sync(self.shared)
+                    written += self.audience.save()
+                    self._audience_saved_at = time.monotonic()
+            except Exception as e:
+                self.metrics["errors"] += 1
+                logger.error("Ошибка сохранения статистики: %s", e)
+                # Изменения останутся в разнице со _flushed и запишутся следующим снимком
+                self._needs_snapshot = True
+                return
+            
+            if self.shared is None:
+                self._flushed = counts
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.metrics["flushes"] += 1
+            self.metrics["bytes_written"] += written
+            self.metrics["last_flush_ms"] = elapsed_ms
+            self.metrics["max_flush_ms"] = max(self.metrics["max_flush_ms"], elapsed_ms)
+            self.metrics["total_flush_ms"] += elapsed_ms
+
+    def _sync_shared(self, counts, delta):
+        """Отправка приращений в общую базу и переход к общим итогам"""
+        reset = self._reset_shared
+        totals = self.shared.sync_counts(counts if reset else delta, reset=reset)
+        self._reset_shared = False
+        # Сдвиг на разницу с отправленным снимком: нажатия, пришедшие после
+        # снимка, остаются в локальных счётчиках и уйдут следующим сбросом
+        for key in totals.keys() | counts.keys():
+            shift = totals.get(key, 0) - counts.get(key, 0)
+            if shift:
+                self._counters.add(key, shift)
+        self._flushed = totals
+
+    def _append_delta(self, delta):
+        self._seq += 1
+        line = json.dumps({"seq": self._seq, "delta": delta}, ensure_ascii=False) + "\n"
+        data = line.encode('utf-8')
+        with open(self.delta_log, 'ab') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self._flushes_since_snapshot += 1
+        return len(data)
+
+    def _write_snapshot(self, counts):
+        data = json.dumps({
+            "button_stats": counts,
+            "delta_seq": self._seq,
+            "saved_at": time.time()
+        }, ensure_ascii=False, indent=2).encode('utf-8')
+        written = atomic_write(self.path, data)
+        # Журнал усекается только после записи снимка: записи с seq <= delta_seq
+        # при следующей загрузке всё равно будут пропущены
+        if self.delta_log and os.path.exists(self.delta_log):
+            open(self.delta_log, 'w').close()
+        self._flushes_since_snapshot = 0
+        self.metrics["snapshots"] += 1
+        return written
+
+    def stats(self):
+        """Метрики записи для /stats"""
+        metrics = dict(self.metrics)
+        metrics["pending_changes"] = sum(map(abs, self._pending_delta(self.snapshot()).values()))
+        metrics["delta_log"] = bool(self.delta_log)
+        metrics["backend"] = "sqlite" if self.shared is not None else "file"
+        if self.shared is not None:
+            metrics["shared"] = self.shared.stats()
+        return metrics
+
+
+# Тексты для разных разделов
+WELCOME_TEXT = """
+<b>Вы находитесь на официальном канале кафедры теории и методики массовой физкультурно-оздоровительной работы НГУ им. П.Ф. Лесгафта, Санкт-Петербург</b>
+"""
+
+NEWS_TEXT = """
+<b>📢 Новости кафедры</b>
+
+Здесь будут размещаться актуальные новости и события кафедры теории и методики массовой физкультурно-оздоровительной работы.
+
+Следите за обновлениями!
+"""
+
+CONSULTATION_SCHEDULE_TEXT = """
+<b>🗓️ Расписание консультаций</b>
+
+Расписание консультаций преподавателей кафедры:
+
+<u>Понедельник:</u> 10:00 - 12:00
+<u>Вторник:</u> 14:00 - 16:00  
+<u>Среда:</u> 10:00 - 12:00
+<u>Четверг:</u> 14:00 - 16:00
+<u>Пятница:</u> 10:00 - 12:00
+
+Для уточнения расписания конкретного преподавателя обращайтесь по телефону кафедры.
+"""
+
+HISTORY_TEXT = """
+<b>📚 История кафедры</b>
+
+Кафедра теории и методики массовой физкультурно-оздоровительной работы была создана в 1983 году как кафедра массовой физкультурно-оздоровительной работы и туризма.
+
+За время существования кафедрой руководили:
+• 1983-1996: к.п.н., доцент В.Г. Каневец
+• 1996-2000: к.п.н., доцент Т.В. Казанкина
+• 2001-2011: академик РАТ Ю.Н. Федотов
+• 2011-2015: Ю.В. Шулико
+• 2015-2025: к.п.н., доцент А.Б. Петров
+• С 2025: к.п.н., доцент Ю.Ю. Вишнякова
+
+Кафедра готовит специалистов по направлениям:
+• Физкультурно-оздоровительные технологии
+• Спортивно-оздоровительный туризм
+• Кёрлинг
+"""
+
+APPLICANTS_TEXT = """
+<b>🎓 Абитуриентам</b>
+
+<u>Направления подготовки:</u>
+• Бакалавриат: 49.03.01 Физическая культура. Направленность (профиль) «Физкультурно-оздоровительная деятельность»
+• Бакалавриат: 49.03.04 Спорт. Направленность (профиль) «Тренерско-преподавательская деятельность в избранном виде спорта» (полиатлон)
+• Магистратура: 49.04.03 Спорт
+
+Уважаемые абитуриенты! Вся актуальная информация на странице приемной комиссии НГУ им. П.Ф.Лесгафта, Санкт-Петербург
+https://lesgaft.spb.ru/ru/commission/priyomnaya-komissiya
+"""
+
+STUDENTS_TEXT = """
+<b>👨‍🎓 Студентам</b>
+
+<u>Учебные материалы:</u>
+Доступ к учебным материалам и расписанию занятий предоставляется через внутренний портал университета.
+
+<u>Зачеты и экзамены:</u>
+Расписание сессии публикуется на кафедре и сайте университета.
+
+<u>Курсовые и дипломные работы:</u>
+Темы курсовых и дипломных работ согласовываются с научными руководителями.
+"""
+
+SPORTS_WORK_TEXT = """
+<b>⚽ Спортивная работа</b>
+
+Кафедра активно участвует в спортивной жизни университета:
+
+• Организация спортивных мероприятий
+• Подготовка сборных команд
+• Проведение соревнований
+• Развитие студенческого спорта
+
+Студенты кафедры регулярно участвуют в различных спортивных соревнованиях городского и всероссийского уровня.
+"""
+
+GTO_TESTING_CENTER_TEXT = """
+<b>🏅 Центр тестирования ГТО</b>
+
+<b>ПОДГОТОВКА К СДАЧЕ НОРМАТИВОВ ВФСК ГТО</b>
+
+<u>📅 Сроки:</u> 
+Первый квартал 2026 года (январь – март)
+
+<u>🕒 График занятий:</u> 
+2 раза в неделю (понедельник, среда) с 17.00
+
+<u>💰 Стоимость обучения:</u> 
+21 500 рублей
+
+<u>📍 Место проведения:</u> 
+Санкт-Петербург, ул. Декабристов, 35.
+
+<u>📞 Контакты:</u>
+Аксенова Наталья Николаевна
+📧 n.aksenova@lesgaft.spb.ru 
+📱 +7 904 618-33-11
+"""
+
+STAFF_TEXT = """
+<b>👨‍🏫 Сотрудники кафедры</b>
+
+<u>Заведующий кафедрой:</u>
+<b>Вишнякова Юлия Юрьевна</b> - к.п.н., доцент, зав. каф.
+
+<u>Профессорско-преподавательский состав:</u>
+• <b>Лаврухина Галина Михайловна</b> - к.п.н., доцент
+• <b>Горбунова Татьяна Владимировна</b> - старший преподаватель
+• <b>Аксенова Наталья Николаевна</b> - к.п.н., доцент
+• <b>Черная Анастасия Игоревна</b> - к.п.н., доцент
+• <b>Фигон Яана Юрьевна</b> - преподаватель
+• <b>Соколов Максим Сергеевич</b> - преподаватель
+• <b>Степин Илья Евгеньевич</b> - преподаватель
+• <b>Константинова Анастасия Константиновна</b> - старший преподаватель
+• <b>Фоль Анастасия Сергеевна</b> - преподаватель
+"""
+
+# Разделы меню: надпись кнопки, название для главной страницы и текст ответа
+SECTIONS = [
+    ("📢 Новости", "📢 Новости кафедры", NEWS_TEXT),
+    ("🗓️ Расписание консультаций", "🗓️ Расписание консультаций", CONSULTATION_SCHEDULE_TEXT),
+    ("📚 История кафедры", "📚 История кафедры", HISTORY_TEXT),
+    ("🎓 Абитуриентам", "🎓 Абитуриентам", APPLICANTS_TEXT),
+    ("👨‍🎓 Студентам", "👨‍🎓 Студентам", STUDENTS_TEXT),
+    ("⚽ Спортивная работа", "⚽ Спортивная работа", SPORTS_WORK_TEXT),
+    ("🏅 Центр тестирования ГТО", "🏅 Центр тестирования ГТО", GTO_TESTING_CENTER_TEXT),
+    ("👨‍🏫 Сотрудники кафедры", "👨‍🏫 Сотрудники кафедры", STAFF_TEXT)
+]
+
+# Клавиатура — по две кнопки в ряд в порядке разделов
+MENU_LAYOUT = [[label for label, _, _ in SECTIONS[i:i + 2]] for i in range(0, len(SECTIONS), 2)]
+
+FALLBACK_TEXT = "Пожалуйста, используйте кнопки меню для навигации."
+
+DEFAULT_STATS = {label: 0 for label, _, _ in SECTIONS}
+
+stats_store = StatsStore(shared=shared_state)
+subscribers = SubscriberRegistry()
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+def encode_message(text, parse_mode=None, reply_markup=None):
+    """JSON-тело sendMessage без chat_id: всё после открывающей скобки"""
+    payload = {"text": text}
+    if parse_mode:
+        payload["parse_mode"] = parse_mode
+    if reply_markup:
+        payload["reply_markup"] = reply_markup
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode('utf-8')[1:]
+
+def message_body(chat_id, encoded):
+    """Полное тело sendMessage из закодированной части и chat_id"""
+    return b'{"chat_id":' + str(chat_id).encode() + b',' + encoded
+
+def format_daily_stats(timeseries, now=None):
+    """Сравнение «сегодня / вчера» и самый загруженный час сегодня для /stat"""
+    now = time.time() if now is None else now
+    offset = STATS_TZ_OFFSET * 3600
+    today_start = (now + offset) // 86400 * 86400 - offset
+    hours = timeseries.rings["hour"].series(today_start - 86400, now)
+    yesterday = sum(sum(counts.values()) for start, counts in hours if start < today_start)
+    today_hours = [(start, sum(counts.values())) for start, counts in hours if start >= today_start]
+    today = sum(total for _, total in today_hours)
+    
+    text = f"<b>📅 Сегодня:</b> {today} (вчера: {yesterday})"
+    busiest_start, busiest = max(today_hours, key=lambda item: item[1], default=(None, 0))
+    if busiest:
+        hour = int((busiest_start + offset) // 3600 % 24)
+        text += f"\n<b>⏰ Пиковый час:</b> {hour:02d}:00–{(hour + 1) % 24:02d}:00 ({busiest})"
+    return text
+
+def format_audience(audience, labels, now=None):
+    """Уникальные пользователи за сегодня, 7 и 30 дней для /stat"""
+    windows = [audience.unique(days, now) for days in (1, 7, 30)]
+    text = "<b>👥 Уникальные пользователи</b> (сегодня / 7 дней / 30 дней):"
+    text += "\n• Всего: " + " / ".join(str(window.get(AudienceStore.ALL, 0)) for window in windows)
+    for label in labels:
+        if windows[-1].get(label):
+            text += f"\n• {label}: " + " / ".join(str(window.get(label, 0)) for window in windows)
+    return text
+
+def parse_window(value):
+    """Длительность вида 90m, 24h или 7d в секундах"""
+    units = {"m": 60, "h": 3600, "d": 86400}
+    if not value or value[-1] not in units or not value[:-1].isdigit():
+        raise ValueError(f"bad window: {value!r}")
+    return int(value[:-1]) * units[value[-1]]
+
+# Теги, которые Telegram принимает в parse_mode=HTML
+TELEGRAM_HTML_TAGS = {"b", "strong", "i", "em", "u", "ins", "s", "strike", "del", "a",
+                      "code", "pre", "span", "tg-spoiler", "tg-emoji", "blockquote"}
+# Атрибуты, без которых Telegram не принимает тег: имя и обязательное значение (None — любое)
+TELEGRAM_HTML_REQUIRED = {"a": ("href", None), "span": ("class", "tg-spoiler"),
+                          "tg-emoji": ("emoji-id", None)}
+# Именованные сущности, которые понимает Telegram; числовые (&#33;) допустимы все
+TELEGRAM_HTML_ENTITIES = {"lt", "gt", "amp", "quot"}
+MESSAGE_LIMIT = 4096
+
+class TelegramHTMLValidator(HTMLParser):
+    """Проверка разметки: допустимые теги и сущности, обязательные атрибуты и вложенность"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.stack = []
+        self.errors = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in TELEGRAM_HTML_TAGS:
+            self.errors.append(f"недопустимый тег <{tag}>")
+        elif tag in TELEGRAM_HTML_REQUIRED:
+            name, value = TELEGRAM_HTML_REQUIRED[tag]
+            actual = dict(attrs).get(name)
+            if not actual or (value is not None and actual != value):
+                self.errors.append(f"<{tag}> без {name}=\"{value or '…'}\"")
+        self.stack.append(tag)
+
+    def handle_entityref(self, name):
+        if name not in TELEGRAM_HTML_ENTITIES:
+            self.errors.append(f"недопустимая сущность &{name};")
+
+    def handle_data(self, data):
+        # Одиночные & и < парсер отдаёт как текст, а Telegram их не принимает
+        for char, entity in (("&", "&amp;"), ("<", "&lt;")):
+            if char in data:
+                self.errors.append(f"символ {char} без экранирования (нужно {entity})")
+
+    def handle_endtag(self, tag):
+        if not self.stack or self.stack[-1] != tag:
+            self.errors.append(f"лишний или непарный </{tag}>")
+            return
+        self.stack.pop()
+
+def validate_html(text):
+    """Список ошибок разметки (пустой, если текст корректен)"""
+    validator = TelegramHTMLValidator()
+    validator.feed(text)
+    validator.close()
+    return validator.errors + [f"не закрыт <{tag}>" for tag in validator.stack]
+
+def split_message(text, limit=MESSAGE_LIMIT):
+    """Разбиение длинного текста на части не длиннее limit по абзацам и строкам"""
+    if len(text) <= limit:
+        return [text]
+    # Куски текста вместе с разделителем, который стоял перед ними
+    pieces = []
+    for paragraph in text.split("\n\n"):
+        if len(paragraph) <= limit:
+            pieces.append(("\n\n", paragraph))
+            continue
+        for number, line in enumerate(paragraph.split("\n")):
+            separator = "\n\n" if number == 0 else "\n"
+            while len(line) > limit:
+                pieces.append((separator, line[:limit]))
+                line = line[limit:]
+                separator = ""
+            pieces.append((separator, line))
+    
+    parts = []
+    current = None
+    for separator, piece in pieces:
+        if current is None:
+            current = piece
+        elif len(current) + len(separator) + len(piece) <= limit:
+            current += separator + piece
+        else:
+            parts.append(current)
+            current = piece
+    parts.append(current)
+    return parts
+
+class Response:
+    """Готовый ответ раздела с заранее закодированными телами запросов
+
+    Текст длиннее лимита Telegram разбит на несколько сообщений: parts —
+    закодированные тела для каждого из них по порядку.
+    """
+
+    __slots__ = ("label", "title", "text", "parts", "media")
+
+    def __init__(self, label, title, text, parts, media=()):
+        self.label = label
+        self.title = title
+        self.text = text
+        self.parts = parts
+        self.media = media
+
+# Тип вложения для Bot API по расширению файла; остальные файлы — документы
+MEDIA_KINDS = {".jpg": "photo", ".jpeg": "photo", ".png": "photo", ".webp": "photo",
+               ".mp4": "video"}
+# Лимиты Bot API на загрузку файлов, байт
+MEDIA_SIZE_LIMITS = {"photo": 10 * 1024 * 1024}
+MEDIA_SIZE_LIMIT = 50 * 1024 * 1024
+CAPTION_LIMIT = 1024
+ALBUM_LIMIT = 10
+
+class MediaItem:
+    """Вложение раздела: локальный файл, тип для Bot API и подпись"""
+
+    __slots__ = ("path", "kind", "caption")
+
+    def __init__(self, path, caption=""):
+        self.path = path
+        self.kind = MEDIA_KINDS.get(os.path.splitext(path)[1].lower(), "document")
+        self.caption = caption
+
+    def validate(self):
+        """Ошибки вложения: нет файла, превышен лимит размера, неверная подпись"""
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return [f"нет файла {self.path}"]
+        errors = []
+        if size > MEDIA_SIZE_LIMITS.get(self.kind, MEDIA_SIZE_LIMIT):
+            errors.append(f"{self.path} больше лимита Telegram ({size} байт)")
+        if len(self.caption) > CAPTION_LIMIT:
+            errors.append(f"подпись к {self.path} длиннее {CAPTION_LIMIT} символов")
+        return errors + validate_html(self.caption)
+
+def media_groups(media):
+    """Деление вложений на отправки: фото и видео подряд — альбом, документы — отдельный альбом
+
+    Telegram не смешивает документы с фото в одном альбоме и принимает
+    не больше ALBUM_LIMIT файлов; группа из одного файла уходит обычным методом.
+    """
+    groups = []
+    for item in media:
+        visual = item.kind != "document"
+        last = groups[-1] if groups else None
+        if last and (last[0].kind != "document") == visual and len(last) < ALBUM_LIMIT:
+            last.append(item)
+        else:
+            groups.append([item])
+    return groups
+
+# Поиск по текстам разделов: стоп-слова, окончания для усечения и синонимы основ
+SEARCH_STOP_WORDS = frozenset("""
+а без бы был была были было быть в вам вас ведь во вот все всех вы где да для до его ее если есть еще же
+за здесь и из или им их к как какая какие какой когда кто ли либо мне можно мы на над не нет ни но ну о об
+он она они от по под пожалуйста подскажите при про с со так также там те тем то тоже только у уже хочу
+чем что чтобы эта эти это этот я
+""".split())
+SEARCH_ENDINGS = sorted("""
+иями ями ами иях ией ого его ому ему ыми ими ией ость ости
+ия ие ий ии ию ья ье ьи ой ый ая яя ое ее ые ом ем ам ям ах ях ов ев ей ую юю ть ет ут ют ит ат ят
+а я о е ы и у ю ь
+""".split(), key=len, reverse=True)
+SEARCH_SYNONYMS = {"цена": "стоимость", "стоит": "стоимость", "оплата": "стоимость",
+                   "препод": "преподаватель", "телефон": "контакты",
+                   "поступить": "абитуриент", "поступление": "абитуриент"}
+
+def strip_ending(word):
+    """Лёгкое усечение русского слова по частым окончаниям"""
+    for ending in SEARCH_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+# Синонимы в виде основ, чтобы подменять их после усечения
+SYNONYM_STEMS = {strip_ending(word): strip_ending(target) for word, target in SEARCH_SYNONYMS.items()}
+
+def stem(word):
+    """Основа слова с заменой синонимов"""
+    word = strip_ending(word)
+    return SYNONYM_STEMS.get(word, word)
+
+def search_terms(text):
+    """Основы слов текста для поиска: без разметки, регистра, «ё» и стоп-слов"""
+    text = html.unescape(re.sub(r"<[^>]+>", " ", text)).lower().replace("ё", "е")
+    return [stem(word) for word in re.findall(r"[0-9a-zа-я]+", text) if word not in SEARCH_STOP_WORDS]
+
+class SearchResult:
+    """Найденный абзац: раздел и готовое тело ответа"""
+
+    __slots__ = ("label", "encoded")
+
+    def __init__(self, label, encoded):
+        self.label = label
+        self.encoded = encoded
+
+class SearchIndex:
+    """Обратный индекс по абзацам разделов для свободных запросов
+
+    Строится вместе с таблицей ответов, поэтому перезагрузка текстов
+    пересобирает и его. Документ — абзац раздела; слова заголовка раздела
+    засчитываются каждому его абзацу. Веса BM25 считаются при сборке, так
+    что запрос — это сложение весов из списков нескольких основ. Результаты
+    для одинакового набора основ кэшируются (LRU на cache_size запросов).
+    """
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, sections, keyboard, cache_size=SEARCH_CACHE_SIZE):
+        self.keyboard = keyboard
+        self.documents = []
+        postings = {}
+        lengths = []
+        for response in sections:
+            title_terms = search_terms(response.title)
+            for paragraph in re.split(r"\n\s*\n", response.text.strip()):
+                terms = search_terms(paragraph)
+                # Абзац-заголовок ничего не добавляет к остальным абзацам раздела
+                if not terms or set(terms) <= set(title_terms):
+                    continue
+                doc = len(self.documents)
+                self.documents.append((response, paragraph.strip()))
+                terms += title_terms
+                lengths.append(len(terms))
+                for term, frequency in collections.Counter(terms).items():
+                    postings.setdefault(term, []).append((doc, frequency))
+        
+        count = len(self.documents)
+        average = sum(lengths) / count if count else 1
+        self.weights = {}
+        for term, docs in postings.items():
+            idf = math.log(1 + (count - len(docs) + 0.5) / (len(docs) + 0.5))
+            self.weights[term] = [
+                (doc, idf * frequency * (self.K1 + 1)
+                 / (frequency + self.K1 * (1 - self.B + self.B * lengths[doc] / average)))
+                for doc, frequency in docs
+            ]
+        self._cached_search = functools.lru_cache(maxsize=cache_size)(self._search)
+
+    def find(self, text):
+        """Лучший абзац для запроса или None"""
+        started = time.perf_counter()
+        terms = tuple(sorted(set(search_terms(text))))
+        result = self._cached_search(terms) if terms else None
+        bot_metrics.search.observe(time.perf_counter() - started)
+        bot_metrics.search_results.add("found" if result else "not_found")
+        return result
+
+    def _search(self, terms):
+        scores = collections.defaultdict(float)
+        for term in terms:
+            for doc, weight in self.weights.get(term, ()):
+                scores[doc] += weight
+        if not scores:
+            return None
+        ranked = sorted(scores, key=scores.get, reverse=True)
+        response, paragraph = self.documents[ranked[0]]
+        best = scores[ranked[0]]
+        others = []
+        for doc in ranked[1:]:
+            label = self.documents[doc][0].label
+            if scores[doc] < best / 2 or len(others) == 2:
+                break
+            if label != response.label and label not in others:
+                others.append(label)
+        
+        if validate_html(paragraph):
+            paragraph = html.escape(html.unescape(re.sub(r"<[^>]+>", "", paragraph)))
+        text = f"<b>{html.escape(response.title)}</b>\n\n{split_message(paragraph)[0]}\n\n"
+        text += f"<i>Полностью — кнопка «{html.escape(response.label)}»</i>"
+        if others:
+            text += "\n<i>Ещё по запросу: " + ", ".join(f"«{html.escape(label)}»" for label in others) + "</i>"
+        return SearchResult(response.label, encode_message(text, "HTML", self.keyboard))
+
+    def stats(self):
+        cache = self._cached_search.cache_info()
+        return {
+            "documents": len(self.documents),
+            "terms": len(self.weights),
+            "cache": {"hits": cache.hits, "misses": cache.misses, "size": cache.currsize}
+        }
+
+class ResponseTable:
+    """Таблица ответов, собираемая один раз при загрузке текстов
+
+    Надпись кнопки сразу отображается в готовый ответ, а JSON с текстом и
+    клавиатурой уже закодирован — при ответе к нему добавляется только chat_id.
+    Разметка проверяется при сборке: ошибки выбрасываются как ValueError.
+    Вместе с таблицей строится поисковый индекс по текстам разделов.
+    media — вложения разделов по надписи кнопки; файлы тоже проверяются при сборке.
+    """
+
+    def __init__(self, sections, layout, welcome_text=WELCOME_TEXT, fallback_text=FALLBACK_TEXT,
+                 media=None):
+        self.keyboard = {"keyboard": layout, "resize_keyboard": True}
+        media = media or {}
+        errors = []
+        self.sections = []
+        for label, title, text in sections:
+            parts = split_message(text)
+            for number, part in enumerate(parts, 1):
+                errors += [f"{label}, часть {number}: {error}" for error in validate_html(part)]
+            attachments = tuple(media.get(label, ()))
+            for item in attachments:
+                errors += [f"{label}, вложение: {error}" for error in item.validate()]
+            encoded = tuple(encode_message(part, "HTML", self.keyboard) for part in parts)
+            self.sections.append(Response(label, title, text, encoded, attachments))
+        errors += [f"приветствие: {error}" for error in validate_html(welcome_text)]
+        labels = {label for row in layout for label in row}
+        errors += [f"кнопка «{label}» без раздела" for label in labels - {s.label for s in self.sections}]
+        if errors:
+            raise ValueError("; ".join(errors))
+        
+        self.by_label = {response.label: response for response in self.sections}
+        self.welcome = encode_message(welcome_text, "HTML", self.keyboard)
+        self.fallback = encode_message(fallback_text, reply_markup=self.keyboard)
+        self.menu_html = "\n            ".join(
+            f"<li>{html.escape(response.title)}</li>" for response in self.sections
+        )
+        self.search = SearchIndex(self.sections, self.keyboard)
+
+    def get(self, label):
+        """Ответ для надписи кнопки или None"""
+        return self.by_label.get(label)
+
+class ContentStore:
+    """Тексты разделов из внешнего файла с горячей перезагрузкой
+
+    Без CONTENT_PATH используются встроенные тексты. Файл — JSON с полями
+    sections (label, title и text или file с путём к тексту относительно
+    файла, необязательный media — список вложений), а также необязательными
+    layout, welcome и fallback; вместо файла
+    можно указать каталог с content.json. Не чаще раза в check_interval при
+    обращении сверяются mtime файлов; изменившиеся тексты проверяются,
+    собираются в новую ResponseTable и подменяют её одним присваиванием.
+    Обработчик берёт таблицу один раз, поэтому начатый ответ дойдёт в той
+    версии, с которой начался. При ошибке в новых текстах остаётся старая таблица.
+    """
+
+    def __init__(self, path=CONTENT_PATH, check_interval=CONTENT_CHECK_INTERVAL):
+        if path and os.path.isdir(path):
+            path = os.path.join(path, "content.json")
+        self.path = path
+        self.check_interval = check_interval
+        self.table = ResponseTable(SECTIONS, MENU_LAYOUT)
+        self.version = 0
+        self.loaded_at = time.time()
+        self.last_error = None
+        self._files = [path] if path else []
+        self._signature = None
+        self._checked_at = time.monotonic()
+        self._reload_lock = threading.Lock()
+        if path:
+            self.reload()
+
+    def current(self):
+        """Актуальная таблица ответов"""
+        if self.path and time.monotonic() - self._checked_at >= self.check_interval:
+            self._checked_at = time.monotonic()
+            if self._file_signature() != self._signature:
+                self.reload()
+        return self.table
+
+    def _file_signature(self):
+        signature = []
+        for path in self._files:
+            try:
+                stat = os.stat(path)
+                signature.append((path, stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                signature.append((path, None, None))
+        return signature
+
+    def reload(self):
+        """Перечитывание текстов; возвращает (успех, описание)"""
+        # Параллельная перезагрузка из другого потока не нужна — хватит одной
+        if not self._reload_lock.acquire(blocking=False):
+            return False, "перезагрузка уже выполняется"
+        try:
+            table, files = self._compile()
+        except Exception as e:
+            self.last_error = str(e)
+            # Не пытаемся перечитывать те же ошибочные файлы при каждом обращении
+            self._signature = self._file_signature()
+            logger.error("Ошибка загрузки текстов из %s: %s", self.path, e)
+            return False, str(e)
+        finally:
+            self._reload_lock.release()
+        
+        self._files = files
+        self._signature = self._file_signature()
+        stats_store.track([response.label for response in table.sections])
+        self.table = table
+        self.version += 1
+        self.loaded_at = time.time()
+        self.last_error = None
+        logger.info("📝 Тексты разделов загружены из %s (версия %s)", self.path, self.version)
+        return True, f"загружено разделов: {len(table.sections)}"
+
+    def _compile(self):
+        base = os.path.dirname(os.path.abspath(self.path))
+        files = [self.path]
+        with open(self.path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        
+        def read_text(item, key):
+            if "file" in item:
+                text_path = os.path.join(base, item["file"])
+                files.append(text_path)
+                with open(text_path, 'r', encoding='utf-8') as text_file:
+                    return text_file.read()
+            return item[key]
+        
+        def read_media(entry):
+            # Строка — путь к файлу, объект — {"file": путь, "caption": подпись}
+            if isinstance(entry, str):
+                entry = {"file": entry}
+            return MediaItem(os.path.join(base, entry["file"]), entry.get("caption", ""))
+        
+        sections = [(item["label"], item.get("title", item["label"]), read_text(item, "text"))
+                    for item in data["sections"]]
+        media = {item["label"]: [read_media(entry) for entry in item["media"]]
+                 for item in data["sections"] if item.get("media")}
+        if not sections:
+            raise ValueError("нет ни одного раздела")
+        labels = [label for label, _, _ in sections]
+        layout = data.get("layout") or [labels[i:i + 2] for i in range(0, len(labels), 2)]
+        table = ResponseTable(sections, layout,
+                              welcome_text=data.get("welcome", WELCOME_TEXT),
+                              fallback_text=data.get("fallback", FALLBACK_TEXT),
+                              media=media)
+        return table, files
+
+    def stats(self):
+        """Состояние текстов для /stats"""
+        return {
+            "source": self.path or "built-in",
+            "version": self.version,
+            "loaded_at": self.loaded_at,
+            "sections": len(self.table.sections),
+            "last_error": self.last_error,
+            "search": dict(self.table.search.stats(), **bot_metrics.search_results.snapshot())
+        }
+
+content = ContentStore()
+
+class MediaCache:
+    """file_id загруженных в Telegram файлов, ключ — SHA-256 содержимого
+
+    Файл загружается один раз, дальше вместо байтов отправляется file_id из
+    ответа Telegram. Для каждого пути запоминаются mtime, размер и хэш: пока
+    они не менялись, файл даже не читается. Изменённый файл хэшируется заново,
+    запись со старым хэшем удаляется, и следующая отправка загрузит новую
+    версию. Одинаковые файлы под разными путями делят один file_id.
+
+    Пока файл загружается, он отмечен в uploading: другие отправки того же
+    содержимого ждут в очереди отправки и берут file_id из этой загрузки.
+    Кэш переживает перезапуск: после загрузок его атомарно пишет в path
+    фоновый поток, чтобы fsync не задерживал потоки отправки.
+    """
+
+    def __init__(self, path=MEDIA_CACHE_FILE):
+        self.path = path
+        self.file_ids = {}
+        self.files = {}
+        self.uploading = set()
+        self._lock = threading.Lock()
+        # Снимок и запись одним куском: иначе старый снимок мог бы записаться поверх нового
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._wake = threading.Event()
+        self._thread = None
+        self.counters = {"hits": 0, "misses": 0, "uploads": 0, "uploaded_bytes": 0,
+                         "shared_uploads": 0, "invalidated": 0, "rejected": 0}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.file_ids = data["file_ids"]
+            self.files = data["files"]
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error("Ошибка загрузки кэша вложений: %s", e)
+
+    def flush(self):
+        """Запись кэша на диск, если он изменился с прошлой записи"""
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                self._dirty = False
+                data = json.dumps({"file_ids": self.file_ids, "files": self.files}, ensure_ascii=False)
+            try:
+                atomic_write(self.path, data.encode('utf-8'))
+            except OSError as e:
+                with self._lock:
+                    self._dirty = True
+                logger.error("Ошибка сохранения кэша вложений: %s", e)
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            self.flush()
+
+    def _schedule_flush(self):
+        # Вызывается под self._lock
+        self._dirty = True
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="media-cache", daemon=True)
+            self._thread.start()
+        self._wake.set()
+
+    def _drop(self, digest):
+        # Старая версия могла остаться под другим путём — тогда её file_id ещё нужен
+        if digest in self.file_ids and all(entry[2] != digest for entry in self.files.values()):
+            del self.file_ids[digest]
+            self.counters["invalidated"] += 1
+
+    def resolve(self, item):
+        """(хэш, file_id, байты) для отправки: file_id из кэша или байты для загрузки
+
+        OSError, если файла больше нет.
+        """
+        stat = os.stat(item.path)
+        signature = [stat.st_mtime_ns, stat.st_size]
+        data = None
+        with self._lock:
+            entry = self.files.get(item.path)
+        if entry is None or entry[:2] != signature:
+            with open(item.path, 'rb') as f:
+                data = f.read()
+            digest = hashlib.sha256(data).hexdigest()
+            with self._lock:
+                self.files[item.path] = signature + [digest]
+                self._dirty = True
+                if entry is not None and entry[2] != digest:
+                    self._drop(entry[2])
+        else:
+            digest = entry[2]
+
+        with self._lock:
+            cached = self.file_ids.get(digest)
+            if cached and cached["kind"] == item.kind:
+                self.counters["hits"] += 1
+                return digest, cached["file_id"], None
+            self.counters["misses"] += 1
+        if data is None:
+            with open(item.path, 'rb') as f:
+                data = f.read()
+        return digest, None, data
+
+    def lookup(self, digest, kind):
+        """file_id, полученный после resolve(): его могла загрузить другая отправка"""
+        with self._lock:
+            cached = self.file_ids.get(digest)
+            if cached and cached["kind"] == kind:
+                self.counters["shared_uploads"] += 1
+                return cached["file_id"]
+        return None
+
+    def start_upload(self, digest):
+        """Отметка о загрузке; False, если это содержимое уже загружает другая отправка"""
+        with self._lock:
+            if digest in self.uploading:
+                return False
+            self.uploading.add(digest)
+            return True
+
+    def finish_upload(self, digest):
+        with self._lock:
+            self.uploading.discard(digest)
+
+    def remember(self, digest, kind, file_id, size):
+        """Запоминает file_id загруженного файла; запись на диск — в фоновом потоке"""
+        with self._lock:
+            self.file_ids[digest] = {"kind": kind, "file_id": file_id}
+            self.counters["uploads"] += 1
+            self.counters["uploaded_bytes"] += size
+            self._schedule_flush()
+
+    def forget(self, digest):
+        """Удаляет file_id, который Telegram отклонил; файл загрузится заново"""
+        with self._lock:
+            if self.file_ids.pop(digest, None) is not None:
+                self.counters["rejected"] += 1
+                self._schedule_flush()
+
+    def stats(self):
+        """Попадания в кэш и объём загрузок для /stats"""
+        with self._lock:
+            result = dict(self.counters, entries=len(self.file_ids), files=len(self.files),
+                          uploading=len(self.uploading))
+        lookups = result["hits"] + result["misses"]
+        result["hit_rate"] = result["hits"] / lookups if lookups else 0.0
+        return result
+
+media_cache = MediaCache()
+
+class TelegramTransport:
+    """HTTP-транспорт к Telegram Bot API с постоянными пулами соединений
+
+    Long polling и отправка сообщений идут через разные сессии, чтобы
+    30-секундный getUpdates не занимал соединения, нужные для ответов.
+    """
+
+    POOLS = ("poll", "send")
+
+    def __init__(self, send_pool_size=TG_SEND_POOL_SIZE, poll_pool_size=TG_POLL_POOL_SIZE,
+                 connect_timeout=TG_CONNECT_TIMEOUT, read_timeout=TG_READ_TIMEOUT,
+                 retries=TG_RETRIES):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.sessions = {
+            "poll": self._make_session(poll_pool_size),
+            "send": self._make_session(send_pool_size),
+        }
+        self._lock = threading.Lock()
+        self._counters = {
+            pool: {"calls": 0, "errors": 0, "retries": 0, "total_time": 0.0, "max_time": 0.0}
+            for pool in self.POOLS
+        }
+
+    @staticmethod
+    def _make_session(pool_size):
+        """Сессия с keep-alive пулом заданного размера"""
+        session = requests.Session()
+        # pool_block: при нехватке соединений ждём свободное вместо одноразового
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def request(self, method, url, pool="send", read_timeout=None, **kwargs):
+        """Запрос к Bot API; при сбросе соединения повторяется до self.retries раз
+
+        Ответ не в формате JSON возвращается как {"ok": False, "error_code": HTTP-статус}.
+        """
+        session = self.sessions[pool]
+        timeout = (self.connect_timeout, read_timeout or self.read_timeout)
+        started = time.monotonic()
+        attempt = 0
+        failed = False
+        try:
+            while True:
+                try:
+                    response = session.request(method, url, timeout=timeout, **kwargs)
+                    try:
+                        return response.json()
+                    except ValueError:
+                        # 502/504 от nginx перед Bot API приходят HTML-страницей:
+                        # отдаём их как ошибку API, чтобы сработали повторы при 5xx
+                        return {"ok": False, "error_code": response.status_code,
+                                "description": f"HTTP {response.status_code}: ответ не в формате JSON"}
+                except requests.exceptions.ConnectionError:
+                    if attempt >= self.retries:
+                        raise
+                    attempt += 1
+                    time.sleep(0.1 * attempt)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            with self._lock:
+                counters = self._counters[pool]
+                counters["calls"] += 1
+                counters["retries"] += attempt
+                counters["errors"] += failed
+                counters["total_time"] += elapsed
+                counters["max_time"] = max(counters["max_time"], elapsed)
+
+    def close(self):
+        """Закрытие всех соединений"""
+        for session in self.sessions.values():
+            session.close()
+
+    def stats(self):
+        """Счётчики вызовов и переиспользования соединений по пулам"""
+        with self._lock:
+            result = {pool: dict(counters) for pool, counters in self._counters.items()}
+        for pool, session in self.sessions.items():
+            opened = sent = 0
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in list(pools.keys()):
+                    connection_pool = pools.get(key)
+                    if connection_pool is None:
+                        continue
+                    opened += connection_pool.num_connections
+                    sent += connection_pool.num_requests
+            counters = result[pool]
+            calls = counters["calls"]
+            counters["avg_time"] = counters["total_time"] / calls if calls else 0.0
+            counters["connections_opened"] = opened
+            counters["http_requests"] = sent
+            counters["connections_reused"] = max(sent - opened, 0)
+            counters["reuse_ratio"] = (sent - opened) / sent if sent else 0.0
+        return result
+
+class TokenBucket:
+    """Ведро токенов: rate отправок в секунду и не больше burst подряд"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Забирает токен и возвращает, сколько секунд подождать перед отправкой"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.paused_until - now)
+
+    def pause(self, seconds):
+        """Запрет отправки на seconds секунд (ответ 429 с retry_after)"""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class OutboundRequest:
+    """Запрос к Bot API, ожидающий отправки в очереди"""
+
+    __slots__ = ("chat_id", "method", "kwargs", "prepare", "future", "enqueued_at", "attempts",
+                 "server_errors", "reserved")
+
+    def __init__(self, chat_id, method, kwargs, prepare=None):
+        self.chat_id = chat_id
+        self.method = method
+        self.kwargs = kwargs
+        # Сборка аргументов перед первой отправкой; None от неё — «ещё не готово»
+        self.prepare = prepare
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+        self.server_errors = 0
+        # Токен чата на следующую попытку уже взят
+        self.reserved = False
+
+class SendQueue:
+    """Очередь исходящих запросов перед Bot API
+
+    Ограничивает общую скорость отправки и скорость в каждом чате ведрами
+    токенов, при 429 приостанавливает отправку на retry_after и повторяет
+    запрос (пока не истёк rate_limit_deadline с постановки), при 5xx
+    повторяет его не больше max_retries раз с экспоненциальной задержкой и джиттером.
+    Запросы одного чата обслуживает один поток, поэтому порядок сообщений
+    в чате сохраняется. Результат запроса — в Future, который возвращает submit().
+
+    Поток спит только на общем ведре. Запрос, которому нужно подождать ведро
+    своего чата или повтор после 5xx, откладывается в кучу потока до момента
+    готовности, а следующие запросы того же чата ждут за ним в очереди чата —
+    остальные чаты этого потока тем временем обслуживаются без задержки.
+    Так же откладывается запрос, чей prepare() вернул None.
+    """
+
+    # Через сколько секунд снова вызвать prepare(), вернувший None
+    PREPARE_RETRY = 0.2
+
+    def __init__(self, sender, workers=SEND_WORKERS, queue_size=SEND_QUEUE_SIZE,
+                 global_rate=SEND_GLOBAL_RATE, chat_rate=SEND_CHAT_RATE,
+                 chat_burst=SEND_CHAT_BURST, max_retries=SEND_MAX_RETRIES,
+                 rate_limit_deadline=SEND_RATE_LIMIT_DEADLINE):
+        self.sender = sender
+        self.queues = [queue.PriorityQueue(maxsize=queue_size) for _ in range(max(workers, 1))]
+        self.global_bucket = TokenBucket(global_rate, max(global_rate, 1))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.rate_limit_deadline = rate_limit_deadline
+        self.threads = []
+        # Отложенные запросы каждого потока: куча (момент готовности, номер, запрос)
+        self.delayed = [[] for _ in self.queues]
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self.metrics = {
+            "sent": 0,
+            "failed": 0,
+            "dropped": 0,
+            "deferred": 0,
+            "retries_429": 0,
+            "retries_5xx": 0,
+            "wait_samples": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0
+        }
+
+    def start(self):
+        """Запуск потоков отправки"""
+        if self.threads:
+            return
+        for index, worker_queue in enumerate(self.queues):
+            thread = threading.Thread(target=self._worker, args=(worker_queue, self.delayed[index]),
+                                      name=f"sender-{index}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, chat_id, method, priority=0, timeout=SEND_ENQUEUE_TIMEOUT, prepare=None, **kwargs):
+        """Постановка запроса в очередь; при переполнении ждёт до timeout и отбрасывает
+
+        prepare — необязательная функция, которая в потоке отправки собирает
+        аргументы запроса вместо kwargs; пока она возвращает None, запрос
+        откладывается, а следующие запросы того же чата ждут за ним.
+        """
+        item = OutboundRequest(chat_id, method, kwargs, prepare)
+        worker_queue = self.queues[hash(chat_id) % len(self.queues)]
+        try:
+            worker_queue.put((priority, next(self._seq), item), timeout=timeout)
+        except queue.Full:
+            self._count("dropped")
+            logger.warning("Очередь отправки переполнена, сообщение для %s отброшено", chat_id,
+                           extra={"chat_id": chat_id})
+            item.future.set_result(None)
+        return item.future
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.metrics[name] += amount
+
+    def _worker(self, worker_queue, delayed):
+        # Ведра и очереди чатов принадлежат одному потоку, поэтому словари без блокировки
+        chat_buckets = {}
+        # Чаты с отложенным запросом: следующие запросы чата ждут за ним по порядку
+        waiting = {}
+        stopping = False
+        while True:
+            now = time.monotonic()
+            if delayed and delayed[0][0] <= now:
+                _, _, item = heapq.heappop(delayed)
+            else:
+                if stopping and not delayed:
+                    break
+                try:
+                    _, _, item = worker_queue.get(timeout=delayed[0][0] - now if delayed else None)
+                except queue.Empty:
+                    continue
+                if item is None:
+                    stopping = True
+                    continue
+                if item.chat_id in waiting:
+                    waiting[item.chat_id].append(item)
+                    continue
+            
+            bucket = chat_buckets.get(item.chat_id)
+            if bucket is None:
+                if len(chat_buckets) > 10000:
+                    idle_since = now - 60
+                    for chat_id in [c for c, b in chat_buckets.items()
+                                    if b.updated < idle_since and c not in waiting]:
+                        del chat_buckets[chat_id]
+                bucket = chat_buckets[item.chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            
+            delay = self._attempt(item, bucket)
+            if delay is not None:
+                waiting.setdefault(item.chat_id, collections.deque())
+                heapq.heappush(delayed, (time.monotonic() + delay, next(self._seq), item))
+            elif item.chat_id in waiting:
+                # Запрос завершён — следующий запрос чата становится в кучу сразу
+                chat_queue = waiting[item.chat_id]
+                if chat_queue:
+                    heapq.heappush(delayed, (time.monotonic(), next(self._seq), chat_queue.popleft()))
+                else:
+                    del waiting[item.chat_id]
+
+    def _attempt(self, item, chat_bucket):
+        """Одна попытка отправки с соблюдением лимитов
+
+        Возвращает, через сколько секунд повторить попытку, или None, если
+        запрос завершён и его результат записан в Future.
+        """
+        if item.prepare is not None:
+            kwargs = item.prepare()
+            if kwargs is None:
+                return self.PREPARE_RETRY
+            item.kwargs = kwargs
+            item.prepare = None
+        if not item.reserved:
+            item.reserved = True
+            wait = chat_bucket.reserve()
+            if wait > 0:
+                self._count("deferred")
+                return wait
+        wait = self.global_bucket.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        item.reserved = False
+        if item.attempts == 0:
+            waited = time.monotonic() - item.enqueued_at
+            with self._lock:
+                self.metrics["wait_samples"] += 1
+                self.metrics["wait_time_total"] += waited
+                self.metrics["wait_time_max"] = max(self.metrics["wait_time_max"], waited)
+        item.attempts += 1
+        
+        started = time.perf_counter()
+        try:
+            result = self.sender(item.method, **item.kwargs)
+        except Exception as e:
+            bot_metrics.api_errors.add("network")
+            self._count("failed")
+            logger.error("Ошибка отправки сообщения: %s", e, extra={"chat_id": item.chat_id})
+            item.future.set_result(None)
+            return None
+        finally:
+            bot_metrics.send_message.observe(time.perf_counter() - started)
+        
+        if result.get("ok"):
+            self._count("sent")
+            item.future.set_result(result)
+            return None
+        
+        error_code = result.get("error_code", 0)
+        bot_metrics.api_errors.add(str(error_code))
+        if error_code == 429:
+            # Лимит Telegram не ошибка запроса: ждём retry_after, ограничено только сроком
+            retry_after = result.get("parameters", {}).get("retry_after", 1)
+            if time.monotonic() + retry_after - item.enqueued_at <= self.rate_limit_deadline:
+                self._count("retries_429")
+                logger.warning("Telegram 429: пауза отправки на %s с", retry_after)
+                # Пауза общая для всех чатов: её выдержит общее ведро перед следующей попыткой
+                self.global_bucket.pause(retry_after)
+                return 0.0
+            retryable = True
+        else:
+            retryable = error_code >= 500
+            if retryable and item.server_errors < self.max_retries:
+                item.server_errors += 1
+                self._count("retries_5xx")
+                return min(SEND_RETRY_BACKOFF * 2 ** (item.server_errors - 1), 30) * random.uniform(0.5, 1.5)
+        
+        self._count("dropped" if retryable else "failed")
+        logger.warning("Telegram отклонил %s для %s: %s %s", item.method, item.chat_id,
+                       error_code, result.get('description'), extra={"chat_id": item.chat_id})
+        item.future.set_result(result)
+        return None
+
+    def stop(self, timeout=None):
+        """Остановка после отправки уже поставленных запросов
 
-# Файл для хранения статистики
-STATS_FILE = "bot_stats.json"
+        Ждёт не дольше timeout секунд; что не успело уйти, остаётся
+        неотправленным, и его количество пишется в журнал.
+        """
+        if not self.threads:
+            return
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for worker_queue in self.queues:
+            try:
+                worker_queue.put((float("inf"), next(self._seq), None), timeout=remaining(deadline))
+            except queue.Full:
+                pass
+        for thread in self.threads:
+            thread.join(remaining(deadline))
+        alive = [index for index, thread in enumerate(self.threads) if thread.is_alive()]
+        if alive:
+            # Знак остановки, до которого поток не дошёл, тоже лежит в очереди
+            queued = max(sum(self.queues[index].qsize() for index in alive) - len(alive), 0)
+            delayed = sum(len(self.delayed[index]) for index in alive)
+            if queued or delayed:
+                logger.warning("Очередь отправки не опустела к сроку остановки: не отправлено "
+                               "в очереди %d, отложенных %d", queued, delayed)
+        self.threads = []
 
-def load_stats():
-    try:
-        if os.path.exists(STATS_FILE):
-            with open(STATS_FILE, 'r', encoding='utf-8') as f:
-                stats = json.load(f)
-                if "📚 История" in stats:
-                    stats["📚 История кафедры"] = stats["📚 История"]
-                    del stats["📚 История"]
-                return stats
-    except Exception as e:
-        logger.error(f"Ошибка загрузки статистики: {e}")
-    
-    return {
-        "📢 Новости": 0,
-        "🗓️ Расписание консультаций": 0,
-        "📚 История кафедры": 0,
-        "🎓 Абитуриентам": 0,
-        "👨‍🎓 Студентам": 0,
-        "⚽ Спортивная работа": 0,
-        "🏅 Центр тестирования ГТО": 0,
-        "👨‍🏫 Сотрудники кафедры": 0
-    }
-
-def save_stats(stats):
-    try:
-        with open(STATS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(stats, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logger.error(f"Ошибка сохранения статистики: {e}")
+    def stats(self):
+        """Глубина очереди, ожидание и потери"""
+        with self._lock:
+            metrics = dict(self.metrics)
+        samples = metrics["wait_samples"]
+        metrics["queue_depth"] = sum(worker_queue.qsize() for worker_queue in self.queues)
+        metrics["delayed"] = sum(len(delayed) for delayed in self.delayed)
+        metrics["wait_time_avg"] = metrics["wait_time_total"] / samples if samples else 0.0
+        return metrics
 
-button_stats = load_stats()
+class Broadcaster:
+    """Рассылка новости всем подписчикам
 
-# Тексты для разных разделов
-WELCOME_TEXT = """
-<b>Вы находитесь на официальном канале кафедры теории и методики массовой физкультурно-оздоровительной работы НГУ им. П.Ф. Лесгафта, Санкт-Петербург</b>
-"""
+    Подписчики обходятся по возрастанию chat_id пакетами по BROADCAST_BATCH.
+    После каждого пакета состояние рассылки сохраняется, поэтому после
+    перезапуска она продолжается с места остановки. Темп рассылки ограничен
+    BROADCAST_RATE, а в очереди отправки её сообщения идут с низким
+    приоритетом, так что ответы на кнопки не ждут окончания рассылки.
+    Чаты, заблокировавшие бота (403), удаляются из подписчиков.
+    """
 
-NEWS_TEXT = """
-<b>📢 Новости кафедры</b>
+    def __init__(self, bot, registry, state_path=BROADCAST_STATE_FILE,
+                 batch_size=BROADCAST_BATCH, rate=BROADCAST_RATE):
+        self.bot = bot
+        self.registry = registry
+        self.state_path = state_path
+        self.batch_size = batch_size
+        self.bucket = TokenBucket(rate, max(rate, 1))
+        self.state = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        if os.path.exists(state_path):
+            try:
+                with open(state_path, 'r', encoding='utf-8') as f:
+                    self.state = json.load(f)
+            except Exception as e:
+                logger.error("Ошибка загрузки состояния рассылки: %s", e)
 
-Здесь будут размещаться актуальные новости и события кафедры теории и методики массовой физкультурно-оздоровительной работы.
+    @staticmethod
+    def validate(text):
+        """Ошибки текста рассылки: разметка и длина проверяются до обхода подписчиков"""
+        errors = validate_html(text)
+        if len(text) > MESSAGE_LIMIT:
+            errors.append(f"текст длиннее {MESSAGE_LIMIT} символов ({len(text)})")
+        return errors
 
-Следите за обновлениями!
-"""
+    def start(self, text, parse_mode="HTML"):
+        """Запуск новой рассылки; False, если предыдущая ещё идёт"""
+        with self._lock:
+            if self.running:
+                return False
+            self.state = {
+                "id": int(time.time()),
+                "text": text,
+                "parse_mode": parse_mode,
+                "status": "running",
+                "cursor": None,
+                "total": len(self.registry),
+                "processed": 0,
+                "sent": 0,
+                "failed": 0,
+                "blocked": 0,
+                "started_at": time.time(),
+                "finished_at": None
+            }
+            self._save()
+            self._launch()
+            return True
 
-CONSULTATION_SCHEDULE_TEXT = """
-<b>🗓️ Расписание консультаций</b>
+    def resume(self):
+        """Продолжение рассылки, прерванной остановкой бота"""
+        with self._lock:
+            if self.state and self.state["status"] == "running" and not self.running:
+                logger.info("Продолжаем рассылку %s: %d из %d", self.state['id'],
+                            self.state['processed'], self.state['total'])
+                self._launch()
 
-Расписание консультаций преподавателей кафедры:
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
 
-<u>Понедельник:</u> 10:00 - 12:00
-<u>Вторник:</u> 14:00 - 16:00  
-<u>Среда:</u> 10:00 - 12:00
-<u>Четверг:</u> 14:00 - 16:00
-<u>Пятница:</u> 10:00 - 12:00
+    def _launch(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="broadcaster", daemon=True)
+        self._thread.start()
 
-Для уточнения расписания конкретного преподавателя обращайтесь по телефону кафедры.
-"""
+    def _save(self):
+        atomic_write(self.state_path, json.dumps(self.state, ensure_ascii=False).encode('utf-8'))
 
-HISTORY_TEXT = """
-<b>📚 История кафедры</b>
+    def _run(self):
+        state = self.state
+        encoded = encode_message(state["text"], state["parse_mode"], content.current().keyboard)
+        cursor = state["cursor"]
+        recipients = [chat_id for chat_id in self.registry.snapshot()
+                      if cursor is None or chat_id > cursor]
+        
+        for start in range(0, len(recipients), self.batch_size):
+            if self._stopped.is_set():
+                return
+            batch = recipients[start:start + self.batch_size]
+            pending = []
+            for chat_id in batch:
+                wait = self.bucket.reserve()
+                if wait > 0:
+                    time.sleep(wait)
+                pending.append((chat_id, self.bot.send_encoded(chat_id, encoded, priority=1)))
+            
+            blocked = []
+            for chat_id, future in pending:
+                result = future.result()
+                if result and result.get("ok"):
+                    state["sent"] += 1
+                elif result and result.get("error_code") == 403:
+                    blocked.append(chat_id)
+                else:
+                    state["failed"] += 1
+            self.registry.remove_many(blocked)
+            state["blocked"] += len(blocked)
+            state["processed"] += len(batch)
+            state["cursor"] = batch[-1]
+            self._save()
+        
+        state["status"] = "done"
+        state["finished_at"] = time.time()
+        self._save()
+        logger.info("📢 Рассылка %s завершена: отправлено %d, заблокировали бота %d, ошибок %d",
+                    state['id'], state['sent'], state['blocked'], state['failed'])
 
-Кафедра теории и методики массовой физкультурно-оздоровительной работы была создана в 1983 году как кафедра массовой физкультурно-оздоровительной работы и туризма.
+    def stop(self, timeout=None):
+        """Остановка после текущего пакета; рассылка продолжится при следующем запуске"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logger.warning("Рассылка %s не остановилась к сроку остановки: продолжится с "
+                               "сохранённого места, получатели текущего пакета могут получить её повторно",
+                               self.state["id"])
 
-За время существования кафедрой руководили:
-• 1983-1996: к.п.н., доцент В.Г. Каневец
-• 1996-2000: к.п.н., доцент Т.В. Казанкина
-• 2001-2011: академик РАТ Ю.Н. Федотов
-• 2011-2015: Ю.В. Шулико
-• 2015-2025: к.п.н., доцент А.Б. Петров
-• С 2025: к.п.н., доцент Ю.Ю. Вишнякова
+    def stats(self):
+        """Прогресс и скорость текущей или последней рассылки"""
+        if not self.state:
+            return None
+        state = dict(self.state)
+        state.pop("text", None)
+        elapsed = (state["finished_at"] or time.time()) - state["started_at"]
+        state["elapsed_seconds"] = elapsed
+        state["messages_per_second"] = state["processed"] / elapsed if elapsed > 0 else 0.0
+        return state
 
-Кафедра готовит специалистов по направлениям:
-• Физкультурно-оздоровительные технологии
-• Спортивно-оздоровительный туризм
-• Кёрлинг
-"""
+class UpdateJournal:
+    """Сохраняемый offset и окно недавно обработанных update_id
 
-APPLICANTS_TEXT = """
-<b>🎓 Абитуриентам</b>
+    Offset — наибольший update_id, до которого включительно всё обработано;
+    он записывается на диск вместе с ограниченным окном последних update_id. Повторно полученное обновление
+    (после перезапуска или повторной доставки webhook) уже есть в окне и
+    пропускается, поэтому нажатия не считаются дважды.
+    """
 
-<u>Направления подготовки:</u>
-• Бакалавриат: 49.03.01 Физическая культура. Направленность (профиль) «Физкультурно-оздоровительная деятельность»
-• Бакалавриат: 49.03.04 Спорт. Направленность (профиль) «Тренерско-преподавательская деятельность в избранном виде спорта» (полиатлон)
-• Магистратура: 49.04.03 Спорт
+    def __init__(self, path=OFFSET_FILE, window=DEDUP_WINDOW):
+        self.path = path
+        self.offset = 0
+        self._recent = collections.deque(maxlen=window)
+        self._seen = set()
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._checkpointed_at = 0.0
+        self.duplicates = 0
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self.offset = data.get("offset", 0)
+                for update_id in data.get("recent", []):
+                    self._remember(update_id)
+            except Exception as e:
+                logger.error("Ошибка загрузки offset: %s", e)
 
-Уважаемые абитуриенты! Вся актуальная информация на странице приемной комиссии НГУ им. П.Ф.Лесгафта, Санкт-Петербург
-https://lesgaft.spb.ru/ru/commission/priyomnaya-komissiya
-"""
+    def _remember(self, update_id):
+        if len(self._recent) == self._recent.maxlen:
+            self._seen.discard(self._recent[0])
+        self._recent.append(update_id)
+        self._seen.add(update_id)
 
-STUDENTS_TEXT = """
-<b>👨‍🎓 Студентам</b>
+    def claim(self, update_id):
+        """True, если обновление ещё не обрабатывалось; отмечает его обработанным"""
+        with self._lock:
+            if update_id in self._seen:
+                self.duplicates += 1
+                return False
+            self._remember(update_id)
+            self._dirty = True
+            return True
 
-<u>Учебные материалы:</u>
-Доступ к учебным материалам и расписанию занятий предоставляется через внутренний портал университета.
+    def release(self, update_id):
+        """Снятие отметки с обновления, которое не удалось поставить в обработку"""
+        with self._lock:
+            if update_id in self._seen:
+                self._seen.discard(update_id)
+                self._recent.remove(update_id)
 
-<u>Зачеты и экзамены:</u>
-Расписание сессии публикуется на кафедре и сайте университета.
+    def advance(self, update_id):
+        """Сдвиг offset вперёд после обработки обновлений"""
+        with self._lock:
+            if update_id > self.offset:
+                self.offset = update_id
+                self._dirty = True
 
-<u>Курсовые и дипломные работы:</u>
-Темы курсовых и дипломных работ согласовываются с научными руководителями.
-"""
+    def checkpoint(self, min_interval=0.0):
+        """Атомарная запись offset и окна на диск, если что-то изменилось"""
+        with self._lock:
+            if not self._dirty or time.monotonic() - self._checkpointed_at < min_interval:
+                return
+            data = json.dumps({"offset": self.offset, "recent": list(self._recent)})
+            self._dirty = False
+            self._checkpointed_at = time.monotonic()
+        try:
+            atomic_write(self.path, data.encode('utf-8'))
+        except Exception as e:
+            self._dirty = True
+            logger.error("Ошибка сохранения offset: %s", e)
 
-SPORTS_WORK_TEXT = """
-<b>⚽ Спортивная работа</b>
+    def stats(self):
+        return {"offset": self.offset, "window": len(self._recent), "duplicates": self.duplicates}
 
-Кафедра активно участвует в спортивной жизни университета:
+class UpdateDispatcher:
+    """Пул обработчиков обновлений с сохранением порядка внутри чата
 
-• Организация спортивных мероприятий
-• Подготовка сборных команд
-• Проведение соревнований
-• Развитие студенческого спорта
+    Обновления одного chat_id всегда попадают в очередь одного и того же
+    обработчика, поэтому ответы в чате идут в порядке сообщений, а разные
+    чаты обрабатываются параллельно. Очереди ограничены: при переполнении
+    submit() блокируется, пока обработчики не освободят место. Поставленные,
+    но ещё не обработанные update_id отслеживаются, чтобы offset можно было
+    сдвигать, не дожидаясь самых медленных обработчиков.
+    """
 
-Студенты кафедры регулярно участвуют в различных спортивных соревнованиях городского и всероссийского уровня.
-"""
+    def __init__(self, handler, workers=DISPATCH_WORKERS, queue_size=DISPATCH_QUEUE_SIZE):
+        self.handler = handler
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(max(workers, 1))]
+        self.threads = []
+        self._idle = threading.Condition()
+        self._pending = 0
+        self._in_flight = set()
+        self.processed = 0
+        self.errors = 0
 
-GTO_TESTING_CENTER_TEXT = """
-<b>🏅 Центр тестирования ГТО</b>
+    def start(self):
+        """Запуск потоков-обработчиков"""
+        if self.threads:
+            return
+        for index, worker_queue in enumerate(self.queues):
+            thread = threading.Thread(target=self._worker, args=(worker_queue,),
+                                      name=f"dispatcher-{index}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
 
-<b>ПОДГОТОВКА К СДАЧЕ НОРМАТИВОВ ВФСК ГТО</b>
+    @staticmethod
+    def chat_key(update):
+        """Ключ упорядочивания: chat_id сообщения или id пользователя"""
+        for value in update.values():
+            if not isinstance(value, dict):
+                continue
+            chat = value.get("chat") or value.get("message", {}).get("chat")
+            if chat:
+                return chat["id"]
+            if "from" in value:
+                return value["from"]["id"]
+        return update.get("update_id", 0)
 
-<u>📅 Сроки:</u> 
-Первый квартал 2026 года (январь – март)
+    def submit(self, update, block=True):
+        """Постановка обновления в очередь обработчика его чата
 
-<u>🕒 График занятий:</u> 
-2 раза в неделю (понедельник, среда) с 17.00
+        С block=False при переполненной очереди возвращает False, не ожидая.
+        """
+        update_id = update.get("update_id")
+        with self._idle:
+            self._pending += 1
+            self._in_flight.add(update_id)
+        worker_queue = self.queues[hash(self.chat_key(update)) % len(self.queues)]
+        try:
+            worker_queue.put(update, block=block)
+        except queue.Full:
+            with self._idle:
+                self._pending -= 1
+                self._in_flight.discard(update_id)
+                if self._pending == 0:
+                    self._idle.notify_all()
+            return False
+        return True
 
-<u>💰 Стоимость обучения:</u> 
-21 500 рублей
+    def oldest_pending(self):
+        """Наименьший update_id среди поставленных и ещё не обработанных или None"""
+        with self._idle:
+            return min(self._in_flight) if self._in_flight else None
 
-<u>📍 Место проведения:</u> 
-Санкт-Петербург, ул. Декабристов, 35.
+    def wait_idle(self, timeout=None):
+        """Ожидание обработки всех поставленных обновлений"""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
 
-<u>📞 Контакты:</u>
-Аксенова Наталья Николаевна
-📧 n.aksenova@lesgaft.spb.ru 
-📱 +7 904 618-33-11
-"""
+    def _worker(self, worker_queue):
+        while True:
+            update = worker_queue.get()
+            if update is None:
+                break
+            failed = False
+            section = None
+            started = time.perf_counter()
+            try:
+                section = self.handler(update)
+            except Exception as e:
+                failed = True
+                logger.error("Ошибка обработки обновления %s: %s", update.get('update_id'), e,
+                             extra={"update_id": update.get('update_id'), "chat_id": self.chat_key(update)})
+            finally:
+                elapsed = time.perf_counter() - started
+                bot_metrics.process_update.observe(elapsed)
+                with self._idle:
+                    self._pending -= 1
+                    self._in_flight.discard(update.get('update_id'))
+                    self.processed += 1
+                    self.errors += failed
+                    if self._pending == 0:
+                        self._idle.notify_all()
+            if not failed:
+                logger.info("Обновление %s обработано", update.get('update_id'), extra={
+                    "update_id": update.get('update_id'), "chat_id": self.chat_key(update),
+                    "section": section, "duration_ms": round(elapsed * 1000, 2)})
 
-STAFF_TEXT = """
-<b>👨‍🏫 Сотрудники кафедры</b>
+    def stop(self, timeout=None):
+        """Остановка обработчиков после разбора уже поставленных обновлений (не дольше timeout)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for worker_queue in self.queues:
+            try:
+                worker_queue.put(None, timeout=remaining(deadline))
+            except queue.Full:
+                pass
+        for thread in self.threads:
+            thread.join(remaining(deadline))
+        pending = self.stats()["pending"]
+        if pending and any(thread.is_alive() for thread in self.threads):
+            logger.warning("Обработчики не завершились к сроку остановки: необработанных обновлений %d",
+                           pending)
+        self.threads = []
 
-<u>Заведующий кафедрой:</u>
-<b>Вишнякова Юлия Юрьевна</b> - к.п.н., доцент, зав. каф.
+    def stats(self):
+        """Состояние очередей обработчиков"""
+        return {
+            "workers": len(self.queues),
+            "queue_depths": [worker_queue.qsize() for worker_queue in self.queues],
+            "pending": self._pending,
+            "processed": self.processed,
+            "errors": self.errors
+        }
 
-<u>Профессорско-преподавательский состав:</u>
-• <b>Лаврухина Галина Михайловна</b> - к.п.н., доцент
-• <b>Горбунова Татьяна Владимировна</b> - старший преподаватель
-• <b>Аксенова Наталья Николаевна</b> - к.п.н., доцент
-• <b>Черная Анастасия Игоревна</b> - к.п.н., доцент
-• <b>Фигон Яана Юрьевна</b> - преподаватель
-• <b>Соколов Максим Сергеевич</b> - преподаватель
-• <b>Степин Илья Евгеньевич</b> - преподаватель
-• <b>Константинова Анастасия Константиновна</b> - старший преподаватель
-• <b>Фоль Анастасия Сергеевна</b> - преподаватель
-"""
+class TelegramAPIError(Exception):
+    """Ответ Bot API с ok=false"""
+
+    def __init__(self, data):
+        super().__init__(data.get("description", "ошибка Bot API"))
+        self.error_code = data.get("error_code", 0)
+        self.retry_after = data.get("parameters", {}).get("retry_after")
+
+class PollBreaker:
+    """Экспоненциальная задержка и автомат-предохранитель для getUpdates
+
+    После каждой ошибки пауза удваивается (со случайным разбросом), а если
+    Telegram прислал retry_after — ждём ровно столько. После
+    POLL_BREAKER_THRESHOLD ошибок подряд предохранитель размыкается (open),
+    следующая попытка идёт в полуоткрытом состоянии (half_open), и первый
+    успешный запрос замыкает его обратно. stuck() сообщает /health, что
+    успешного getUpdates не было дольше POLL_STUCK_AFTER — из-за ошибок или
+    потому, что цикл опроса остановился без них.
+    """
+
+    def __init__(self, base=POLL_BACKOFF_BASE, cap=POLL_BACKOFF_MAX,
+                 threshold=POLL_BREAKER_THRESHOLD, stuck_after=POLL_STUCK_AFTER):
+        self.base = base
+        self.cap = cap
+        self.threshold = threshold
+        self.stuck_after = stuck_after
+        self.state = "closed"
+        self.failures = 0
+        self.trips = 0
+        self.last_success = time.monotonic()
+        self.last_error = None
+
+    def restart(self):
+        """Начало отсчёта заново: опрос только начался или аренда только получена"""
+        self.last_success = time.monotonic()
+
+    def attempt(self):
+        """Отметка о новой попытке; после размыкания она пробная"""
+        if self.state == "open":
+            self.state = "half_open"
+
+    def success(self):
+        if self.state != "closed":
+            logger.info("✅ Получение обновлений восстановлено после %d ошибок", self.failures)
+        self.state = "closed"
+        self.failures = 0
+        self.last_success = time.monotonic()
+
+    def failure(self, error, retry_after=None):
+        """Учёт ошибки; возвращает паузу перед следующей попыткой, с"""
+        self.failures += 1
+        self.last_error = str(error)
+        if self.state != "open" and self.failures >= self.threshold:
+            if self.state == "closed":
+                logger.error("⛔ getUpdates: %d ошибок подряд, последняя: %s", self.failures, error)
+            self.state = "open"
+            self.trips += 1
+        if retry_after:
+            return float(retry_after)
+        return min(self.cap, self.base * 2 ** (self.failures - 1)) * random.uniform(0.5, 1.0)
+
+    def stuck(self):
+        """Успешного getUpdates не было дольше stuck_after
+
+        Исправный long polling завершается хотя бы раз в TG_POLL_TIMEOUT,
+        поэтому долгая пауза означает зависание, даже если ошибок не было.
+        """
+        return time.monotonic() - self.last_success > self.stuck_after
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "trips": self.trips,
+            "seconds_since_success": round(time.monotonic() - self.last_success, 1),
+            "last_error": self.last_error
+        }
 
 class TelegramBot:
-    def __init__(self):
+    def __init__(self, transport=None):
         self.token = BOT_TOKEN
         self.base_url = f"https://api.telegram.org/bot{self.token}/"
-        self.last_update_id = 0
-        
+        self.journal = UpdateJournal()
+        self.breaker = PollBreaker()
+        self.shared = shared_state
+        self.instance_id = INSTANCE_ID
+        # Без общей базы этот экземпляр единственный и всегда опрашивает Telegram
+        self.is_poller = self.shared is None
+        # Запущен ли цикл опроса: в режиме webhook getUpdates не вызывается
+        self.polling = False
+        self.last_update_id = self.journal.offset
+        self.transport = transport or TelegramTransport()
+        self.dispatcher = UpdateDispatcher(self.process_update)
+        self.outbox = SendQueue(self.call_api)
+        self.broadcaster = Broadcaster(self, subscribers)
+        self.webhook_secret = WEBHOOK_SECRET or self._generate_webhook_secret()
+        self.webhook_active = False
+        self._stopping = threading.Event()
+        # Удерживается, пока пакет обновлений обрабатывается; shutdown() ждёт его
+        self._batch_lock = threading.Lock()
+
+    def _generate_webhook_secret(self):
+        """Случайный секрет webhook, с общей базой — один на все экземпляры
+
+        Каждый setWebhook заменяет прежнюю регистрацию, поэтому при разных
+        секретах запросы Telegram принимал бы только последний экземпляр.
+        """
+        secret = secrets.token_urlsafe(32)
+        if self.shared is None:
+            return secret
+        return self.shared.setting("webhook_secret", secret)
+
     def send_message(self, chat_id, text, parse_mode=None, reply_markup=None):
         """Отправка сообщения через Telegram Bot API"""
-        url = self.base_url + "sendMessage"
-        payload = {
-            "chat_id": chat_id,
-            "text": text,
-            "parse_mode": parse_mode
-        }
-        
-        if reply_markup:
-            payload["reply_markup"] = reply_markup
+        return self.send_encoded(chat_id, encode_message(text, parse_mode, reply_markup))
+    
+    def send_encoded(self, chat_id, encoded, priority=0):
+        """Постановка в очередь отправки сообщения с заранее закодированным телом
+
+        Возвращает Future с ответом Bot API (None при ошибке сети или потере).
+        """
+        return self.outbox.submit(chat_id, "sendMessage", priority=priority,
+                                  data=message_body(chat_id, encoded), headers=JSON_HEADERS)
+
+    def send_media(self, chat_id, media, priority=0):
+        """Постановка в очередь отправки вложений раздела
+
+        Одиночный файл уходит через sendPhoto/sendVideo/sendDocument, несколько
+        подряд — альбомом sendMediaGroup. Известные файлы отправляются по
+        file_id из media_cache, новые и изменённые загружаются, а file_id из
+        ответа запоминается. Запрос собирается в потоке отправки перед первой
+        попыткой: если тот же файл в это время загружает другая отправка, запрос
+        ждёт её file_id. Возвращает список Future, по одному на отправку.
+        """
+        futures = []
+        for group in media_groups(media):
+            resolved = []
+            for item in group:
+                try:
+                    resolved.append((item,) + media_cache.resolve(item))
+                except OSError as e:
+                    logger.error("Вложение %s недоступно: %s", item.path, e, extra={"chat_id": chat_id})
+            if not resolved:
+                continue
             
+            method = "send" + resolved[0][0].kind.capitalize() if len(resolved) == 1 else "sendMediaGroup"
+            uploads, cached = [], []
+            future = self.outbox.submit(chat_id, method, priority=priority, prepare=functools.partial(
+                self._media_request, chat_id, resolved, uploads, cached))
+            future.add_done_callback(
+                lambda done, uploads=uploads, cached=cached: self._remember_media(done.result(), uploads, cached))
+            futures.append(future)
+        return futures
+
+    @staticmethod
+    def _media_request(chat_id, resolved, uploads, cached):
+        """Аргументы запроса вложений или None, пока файл загружает другая отправка
+
+        В uploads попадают загружаемые файлы (позиция, хэш, тип, размер), в
+        cached — хэши файлов, отправленных по file_id.
+        """
+        refs, files, claimed, known, sending = [], {}, [], [], []
+        for index, (item, digest, file_id, data) in enumerate(resolved):
+            if file_id is None:
+                file_id = media_cache.lookup(digest, item.kind)
+            if file_id is not None:
+                known.append(digest)
+            else:
+                if digest not in claimed and not media_cache.start_upload(digest):
+                    for started in claimed:
+                        media_cache.finish_upload(started)
+                    return None
+                claimed.append(digest)
+                name = f"file{index}"
+                files[name] = (os.path.basename(item.path), data)
+                file_id = f"attach://{name}"
+                sending.append((index, digest, item.kind, len(data)))
+            refs.append((item, file_id))
+        uploads.extend(sending)
+        cached.extend(known)
+        
+        if len(refs) == 1:
+            item, file_id = refs[0]
+            payload = {"chat_id": chat_id, item.kind: file_id}
+            if item.caption:
+                payload.update(caption=item.caption, parse_mode="HTML")
+        else:
+            album = [{"type": item.kind, "media": file_id} for item, file_id in refs]
+            for entry, (item, _) in zip(album, refs):
+                if item.caption:
+                    entry.update(caption=item.caption, parse_mode="HTML")
+            payload = {"chat_id": chat_id, "media": json.dumps(album, ensure_ascii=False)}
+        return {"data": payload, "files": files or None}
+
+    @staticmethod
+    def _remember_media(result, uploads, cached):
+        """Разбор ответа на отправку вложений: новые file_id в кэш, отклонённые — из кэша"""
+        try:
+            if result is None:
+                return
+            if not result.get("ok"):
+                # 400 на отправку по file_id: файл удалён из Telegram или id от другого бота
+                if result.get("error_code") == 400:
+                    for digest in cached:
+                        media_cache.forget(digest)
+                return
+            messages = result["result"]
+            if isinstance(messages, dict):
+                messages = [messages]
+            for position, digest, kind, size in uploads:
+                if position >= len(messages):
+                    continue
+                message = messages[position]
+                # Фото приходит в нескольких размерах; последний — исходный
+                attachment = message.get(kind)
+                if kind == "photo" and attachment:
+                    attachment = attachment[-1]
+                if attachment and "file_id" in attachment:
+                    media_cache.remember(digest, kind, attachment["file_id"], size)
+        finally:
+            # Сначала file_id в кэше, потом снятие отметки: ждущие отправки возьмут его
+            for _, digest, _, _ in uploads:
+                media_cache.finish_upload(digest)
+
+    def call_api(self, method, **kwargs):
+        """Синхронный POST-запрос к методу Bot API"""
+        return self.transport.request("POST", self.base_url + method, **kwargs)
+    
+    def set_webhook(self, url):
+        """Регистрация webhook с секретным токеном"""
+        payload = {"url": url, "secret_token": self.webhook_secret,
+                   "allowed_updates": ALLOWED_UPDATES}
+        try:
+            return self.call_api("setWebhook", json=payload)
+        except Exception as e:
+            logger.error("Ошибка регистрации webhook: %s", e)
+            return None
+    
+    def delete_webhook(self):
+        """Удаление webhook"""
         try:
-            response = requests.post(url, json=payload, timeout=10)
-            return response.json()
+            return self.call_api("deleteWebhook")
         except Exception as e:
-            logger.error(f"Ошибка отправки сообщения: {e}")
+            logger.error("Ошибка удаления webhook: %s", e)
             return None
     
     def get_updates(self):
-        """Получение обновлений от Telegram"""
+        """Получение обновлений от Telegram
+
+        Ошибки сети пробрасываются как есть, ответ ok=false — как
+        TelegramAPIError; паузу между попытками выбирает run_polling().
+        """
         url = self.base_url + "getUpdates"
         params = {
             "offset": self.last_update_id + 1,
-            "timeout": 30
+            "timeout": TG_POLL_TIMEOUT,
+            "limit": POLL_LIMIT,
+            "allowed_updates": json.dumps(ALLOWED_UPDATES)
         }
         
+        started = time.perf_counter()
         try:
-            response = requests.get(url, params=params, timeout=35)
-            data = response.json()
-            
-            if data.get("ok"):
-                return data["result"]
-            return []
-        except Exception as e:
-            logger.error(f"Ошибка получения обновлений: {e}")
-            return []
+            data = self.transport.request("GET", url, pool="poll", params=params,
+                                          read_timeout=TG_POLL_TIMEOUT + 5)
+        except Exception:
+            bot_metrics.api_errors.add("network")
+            raise
+        finally:
+            bot_metrics.get_updates.observe(time.perf_counter() - started)
+        
+        if not data.get("ok"):
+            bot_metrics.api_errors.add(str(data.get("error_code", 0)))
+            raise TelegramAPIError(data)
+        bot_metrics.updates_per_batch.observe(len(data["result"]))
+        return data["result"]
     
     def process_update(self, update):
-        """Обработка одного обновления"""
+        """Обработка одного обновления; возвращает раздел или команду для журнала"""
         if "message" in update:
             message = update["message"]
             chat_id = message["chat"]["id"]
             text = message.get("text", "")
-            
-            # Обновляем last_update_id
-            self.last_update_id = update["update_id"]
+            if "date" in message:
+                bot_metrics.update_lag.observe(time.time() - message["date"])
             
             # Обрабатываем команды и текстовые сообщения
             if text == "/start":
@@ -238,88 +3091,87 @@ class TelegramBot:
                 self.handle_stat(chat_id)
             elif text == "/statreset":
                 self.handle_statreset(chat_id)
+            elif text == "/reload":
+                self.handle_reload(chat_id)
+            elif text.startswith("/broadcast"):
+                self.handle_broadcast(chat_id, text[len("/broadcast"):].strip())
             else:
-                self.handle_text_message(chat_id, text)
+                return self.handle_text_message(chat_id, text)
+            return text.split(maxsplit=1)[0]
     
     def handle_start(self, chat_id):
         """Обработка команды /start"""
-        keyboard = {
-            "keyboard": [
-                ["📢 Новости", "🗓️ Расписание консультаций"],
-                ["📚 История кафедры", "🎓 Абитуриентам"],
-                ["👨‍🎓 Студентам", "⚽ Спортивная работа"],
-                ["🏅 Центр тестирования ГТО", "👨‍🏫 Сотрудники кафедры"]
-            ],
-            "resize_keyboard": True
-        }
-        
-        self.send_message(chat_id, WELCOME_TEXT, parse_mode="HTML", reply_markup=keyboard)
-        logger.info(f"Пользователь {chat_id} запустил бота")
+        self.send_encoded(chat_id, content.current().welcome)
+        if subscribers.add(chat_id):
+            logger.info("Пользователь %s запустил бота", chat_id, extra={"chat_id": chat_id})
     
     def handle_stat(self, chat_id):
         """Обработка команды /stat"""
         stat_text = "<b>📊 Статистика обращений:</b>\n\n"
+        button_stats = stats_store.snapshot()
         for button, count in button_stats.items():
             stat_text += f"• {button}: {count}\n"
         stat_text += f"\nВсего: {sum(button_stats.values())}"
+        stat_text += "\n\n" + format_daily_stats(stats_store.timeseries)
+        stat_text += "\n\n" + format_audience(stats_store.audience, list(button_stats))
         
         self.send_message(chat_id, stat_text, parse_mode="HTML")
     
     def handle_statreset(self, chat_id):
         """Обработка команды /statreset"""
-        for button in button_stats:
-            button_stats[button] = 0
-        save_stats(button_stats)
+        stats_store.reset()
         self.send_message(chat_id, "✅ Статистика сброшена!")
     
-    def handle_text_message(self, chat_id, text):
-        """Обработка текстовых сообщений"""
-        keyboard = {
-            "keyboard": [
-                ["📢 Новости", "🗓️ Расписание консультаций"],
-                ["📚 История кафедры", "🎓 Абитуриентам"],
-                ["👨‍🎓 Студентам", "⚽ Спортивная работа"],
-                ["🏅 Центр тестирования ГТО", "👨‍🏫 Сотрудники кафедры"]
-            ],
-            "resize_keyboard": True
-        }
+    def handle_broadcast(self, chat_id, text):
+        """Обработка команды /broadcast <текст> (только для администраторов)"""
+        if chat_id not in ADMIN_IDS:
+            self.send_message(chat_id, "⛔ Команда доступна только администраторам.")
+            return
+        if not text:
+            self.send_message(chat_id, "Использование: /broadcast текст новости")
+            return
         
-        if text == "📢 Новости":
-            button_stats["📢 Новости"] += 1
-            self.send_message(chat_id, NEWS_TEXT, parse_mode="HTML", reply_markup=keyboard)
-            
-        elif text == "🗓️ Расписание консультаций":
-            button_stats["🗓️ Расписание консультаций"] += 1
-            self.send_message(chat_id, CONSULTATION_SCHEDULE_TEXT, parse_mode="HTML", reply_markup=keyboard)
-            
-        elif text == "📚 История кафедры":
-            button_stats["📚 История кафедры"] += 1
-            self.send_message(chat_id, HISTORY_TEXT, parse_mode="HTML", reply_markup=keyboard)
-            
-        elif text == "🎓 Абитуриентам":
-            button_stats["🎓 Абитуриентам"] += 1
-            self.send_message(chat_id, APPLICANTS_TEXT, parse_mode="HTML", reply_markup=keyboard)
-            
-        elif text == "👨‍🎓 Студентам":
-            button_stats["👨‍🎓 Студентам"] += 1
-            self.send_message(chat_id, STUDENTS_TEXT, parse_mode="HTML", reply_markup=keyboard)
-            
-        elif text == "⚽ Спортивная работа":
-            button_stats["⚽ Спортивная работа"] += 1
-            self.send_message(chat_id, SPORTS_WORK_TEXT, parse_mode="HTML", reply_markup=keyboard)
-            
-        elif text == "🏅 Центр тестирования ГТО":
-            button_stats["🏅 Центр тестирования ГТО"] += 1
-            self.send_message(chat_id, GTO_TESTING_CENTER_TEXT, parse_mode="HTML", reply_markup=keyboard)
-            
-        elif text == "👨‍🏫 Сотрудники кафедры":
-            button_stats["👨‍🏫 Сотрудники кафедры"] += 1
-            self.send_message(chat_id, STAFF_TEXT, parse_mode="HTML", reply_markup=keyboard)
-            
+        news = f"<b>📢 Новости кафедры</b>\n\n{html.escape(text)}"
+        errors = self.broadcaster.validate(news)
+        if errors:
+            self.send_message(chat_id, f"❌ {html.escape('; '.join(errors))}", parse_mode="HTML")
+            return
+        if self.broadcaster.start(news):
+            self.send_message(chat_id, f"📢 Рассылка запущена: {len(subscribers)} подписчиков")
         else:
-            self.send_message(chat_id, "Пожалуйста, используйте кнопки меню для навигации.", reply_markup=keyboard)
+            self.send_message(chat_id, "⏳ Предыдущая рассылка ещё не завершена.")
+    
+    def handle_reload(self, chat_id):
+        """Обработка команды /reload: перечитать тексты разделов (только для администраторов)"""
+        if chat_id not in ADMIN_IDS:
+            self.send_message(chat_id, "⛔ Команда доступна только администраторам.")
+            return
+        if not content.path:
+            self.send_message(chat_id, "Тексты встроены в код: CONTENT_PATH не задан.")
+            return
+        ok, message = content.reload()
+        self.send_message(chat_id, f"{'✅' if ok else '❌'} {html.escape(message)}", parse_mode="HTML")
+    
+    def handle_text_message(self, chat_id, text):
+        """Обработка текстовых сообщений и поиска; возвращает надпись раздела или None"""
+        # Таблицу берём один раз: перезагрузка текстов не затронет начатый ответ
+        table = content.current()
+        response = table.get(text)
+        if response is None:
+            # Не кнопка — ищем ответ в текстах разделов
+            found = table.search.find(text)
+            if found is None:
+                self.send_encoded(chat_id, table.fallback)
+                return None
+            self.send_encoded(chat_id, found.encoded)
+            return f"🔎 {found.label}"
         
-        save_stats(button_stats)
+        stats_store.increment(response.label, chat_id=chat_id)
+        for encoded in response.parts:
+            self.send_encoded(chat_id, encoded)
+        if response.media:
+            self.send_media(chat_id, response.media)
+        return response.label
     
     def run_polling(self):
         """Запуск бота в режиме polling"""
@@ -328,196 +3180,543 @@ class TelegramBot:
             return
         
         logger.info("🤖 Бот запускается в режиме polling...")
+        # getUpdates не работает, пока зарегистрирован webhook
+        self.delete_webhook()
+        self.outbox.start()
+        self.dispatcher.start()
+        self.broadcaster.resume()
+        self.breaker.restart()
+        self.polling = True
         
-        while True:
+        while not self._stopping.is_set():
+            if not self.hold_poller_lease():
+                self._stopping.wait(LEASE_RETRY_INTERVAL)
+                continue
+            self.breaker.attempt()
+            started = time.monotonic()
             try:
                 updates = self.get_updates()
-                for update in updates:
-                    self.process_update(update)
+            except Exception as e:
+                delay = self.breaker.failure(e, getattr(e, "retry_after", None))
+                logger.warning("Ошибка получения обновлений: %s; повтор через %.1f с", e, delay)
+                self._stopping.wait(delay)
+                continue
+            self.breaker.success()
+            
+            try:
+                with self._batch_lock:
+                    if self._stopping.is_set():
+                        # Пакет не подтверждён Telegram и придёт снова после перезапуска
+                        break
+                    # При заполненных очередях submit() ждёт место — опрос притормаживает
+                    for update in updates:
+                        if self.journal.claim(update["update_id"]):
+                            self.dispatcher.submit(update)
+                    
+                    # Следующий getUpdates подтвердит пакет, не дожидаясь медленных
+                    # обработчиков; на диск идёт offset, до которого всё обработано
+                    if updates:
+                        self.last_update_id = max(update["update_id"] for update in updates)
+                    self.commit_offset()
+                    self.journal.checkpoint(min_interval=1.0)
                 
-                time.sleep(0.1)
+                # Следующий пакет запрашиваем сразу: long polling сам ждёт новых
+                # обновлений, а за полным пакетом (POLL_LIMIT) они уже в очереди.
+                # Пустой ответ раньше таймаута — короткая пауза от холостого цикла
+                if not updates and time.monotonic() - started < 1:
+                    self._stopping.wait(0.1)
                 
             except Exception as e:
-                logger.error(f"Ошибка в основном цикле бота: {e}")
-                time.sleep(5)
+                logger.error("Ошибка в основном цикле бота: %s", e)
+                self._stopping.wait(5)
 
-def create_app():
+    def polling_stuck(self):
+        """Этот экземпляр должен опрашивать Telegram, но давно не получал обновлений"""
+        return self.polling and self.is_poller and self.breaker.stuck()
+
+    def commit_offset(self):
+        """Сдвиг offset журнала до update_id, перед которым всё уже обработано"""
+        oldest = self.dispatcher.oldest_pending()
+        self.journal.advance(self.last_update_id if oldest is None else oldest - 1)
+
+    def hold_poller_lease(self):
+        """Захват или продление аренды getUpdates в общей базе
+
+        Вызывается перед каждым запросом обновлений. При потере связи с базой
+        опрос приостанавливается: иначе после истечения аренды Telegram
+        получил бы запросы от двух экземпляров.
+        """
+        if self.shared is None:
+            return True
+        try:
+            offset = self.shared.acquire_lease("poller", self.instance_id, LEASE_TTL, self.last_update_id)
+        except sqlite3.Error as e:
+            logger.error("Ошибка продления аренды опроса: %s", e)
+            offset = None
+        
+        was_poller = self.is_poller
+        self.is_poller = offset is not None
+        if self.is_poller and not was_poller:
+            self.breaker.restart()
+            logger.info("🗳 Экземпляр %s получил аренду опроса, offset %d", self.instance_id, offset)
+            # Продолжаем с места, где остановился предыдущий держатель
+            if offset > self.last_update_id:
+                self.last_update_id = offset
+                self.journal.advance(offset)
+        elif was_poller and not self.is_poller:
+            logger.warning("Экземпляр %s потерял аренду опроса", self.instance_id)
+        return self.is_poller
+
+    def run_webhook(self, url):
+        """Запуск бота в режиме webhook: обновления приходят в create_app()"""
+        self.outbox.start()
+        self.dispatcher.start()
+        self.broadcaster.resume()
+        result = self.set_webhook(url)
+        if not result or not result.get("ok"):
+            logger.error("❌ Не удалось зарегистрировать webhook: %s", result)
+            return False
+        self.webhook_active = True
+        logger.info("🤖 Бот принимает обновления через webhook %s", url)
+        return True
+    
+    def shutdown(self):
+        """Плавная остановка: новых обновлений не берём, начатые дорабатываем
+
+        После снятия webhook и завершения текущего пакета polling дожидаемся
+        обработки принятых обновлений и отправки ответов, затем записываем
+        итоговый offset. Все этапы вместе укладываются в SHUTDOWN_TIMEOUT:
+        каждый получает время, оставшееся от предыдущих, а брошенная работа
+        попадает в журнал.
+        """
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        self._stopping.set()
+        if self.webhook_active:
+            # С общей базой остальные экземпляры продолжают принимать обновления
+            if self.shared is None:
+                self.delete_webhook()
+                logger.info("🛑 Webhook удалён")
+            self.webhook_active = False
+        if self._batch_lock.acquire(timeout=remaining(deadline)):
+            self._batch_lock.release()
+        if self.shared is not None and self.is_poller:
+            # Освобождаем аренду сразу, не дожидаясь истечения срока
+            try:
+                self.shared.release_lease("poller", self.instance_id, self.last_update_id)
+            except sqlite3.Error as e:
+                logger.error("Ошибка освобождения аренды опроса: %s", e)
+            self.is_poller = False
+        self.broadcaster.stop(timeout=remaining(deadline))
+        if not self.dispatcher.wait_idle(timeout=remaining(deadline)):
+            logger.warning("Не все обновления обработаны до остановки")
+        self.dispatcher.stop(timeout=remaining(deadline))
+        self.commit_offset()
+        self.outbox.stop(timeout=remaining(deadline))
+        media_cache.flush()
+        self.journal.checkpoint()
+        logger.info("🛑 Бот остановлен, offset %d", self.journal.offset)
+
+# Стили главной страницы отдаются отдельным файлом /style.css и кэшируются браузером
+HOME_CSS = """
+body { 
+    font-family: Arial, sans-serif; 
+    max-width: 800px; 
+    margin: 0 auto; 
+    padding: 20px;
+    background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+    color: white;
+}
+.container {
+    background: rgba(255,255,255,0.1);
+    backdrop-filter: blur(10px);
+    padding: 30px;
+    border-radius: 15px;
+    box-shadow: 0 8px 32px rgba(0,0,0,0.1);
+}
+.status { 
+    padding: 15px; 
+    border-radius: 10px; 
+    margin: 20px 0; 
+    text-align: center;
+}
+.running { 
+    background: rgba(76, 175, 80, 0.2); 
+    border: 2px solid #4CAF50;
+}
+a { 
+    color: #ffeb3b; 
+    text-decoration: none; 
+    font-weight: bold;
+}
+a:hover { 
+    text-decoration: underline; 
+}
+.stats-grid {
+    display: grid;
+    grid-template-columns: repeat(auto-fit, minmax(200px, 1fr));
+    gap: 15px;
+    margin: 20px 0;
+}
+.stat-item {
+    background: rgba(255,255,255,0.1);
+    padding: 15px;
+    border-radius: 10px;
+    text-align: center;
+}
+"""
+
+# Главная страница; меню подставляется при смене текстов, числа — на каждый запрос
+HOME_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+    <title>🤖 Бот кафедры ТиМ МФОР</title>
+    <meta charset="utf-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1">
+    <link rel="stylesheet" href="/style.css">
+</head>
+<body>
+    <div class="container">
+        <h1>🤖 Telegram Bot</h1>
+        <h2>Кафедра теории и методики массовой физкультурно-оздоровительной работы</h2>
+        <p>НГУ им. П.Ф. Лесгафта, Санкт-Петербург</p>
+        
+        <div class="status running">
+            <strong>Статус:</strong> ✅ Активен и работает
+        </div>
+        
+        <div class="stats-grid">
+            <div class="stat-item">
+                <h3>📊 Всего запросов</h3>
+                <p>{total_requests}</p>
+            </div>
+            <div class="stat-item">
+                <h3>🕒 Время работы</h3>
+                <p>{uptime}</p>
+            </div>
+        </div>
+        
+        <h2>📋 Меню бота</h2>
+        <ul>
+            {menu_html}
+        </ul>
+        
+        <h2>🔗 Ссылки</h2>
+        <ul>
+            <li><a href="/health">Проверить статус сервиса</a></li>
+            <li><a href="/stats">Посмотреть статистику бота</a></li>
+            <li><a href="https://lesgaft.spb.ru">Сайт университета</a></li>
+        </ul>
+    </div>
+</body>
+</html>
+"""
+
+class HomePage:
+    """Главная страница, заранее собранная для текущей таблицы ответов
+
+    Статическая часть страницы рендерится один раз на ResponseTable, на
+    запрос остаётся склеить её куски с числом запросов и временем работы.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.parts = HOME_TEMPLATE.format(menu_html=table.menu_html,
+                                          total_requests="\0", uptime="\0").split("\0")
+        self.etag = hashlib.sha1("".join(self.parts).encode('utf-8')).hexdigest()[:16]
+
+    def render(self, total_requests, uptime):
+        return f"{self.parts[0]}{total_requests}{self.parts[1]}{uptime}{self.parts[2]}"
+
+class TTLCache:
+    """Кэш вычисленных значений на ttl секунд
+
+    Для ответов, которые часто запрашивают мониторинги: значение считается
+    не чаще раза в ttl секунд на ключ. Одновременные промахи могут посчитать
+    значение дважды — это дешевле, чем держать блокировку на время расчёта.
+    """
+
+    def __init__(self, ttl=STATS_CACHE_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None and now - entry[0] < self.ttl:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        value = compute()
+        # Ключи — строки запроса; ограничиваем число, чтобы случайные параметры не копились
+        if len(self._entries) >= 64:
+            self._entries.clear()
+        self._entries[key] = (now, value)
+        return value
+
+    def stats(self):
+        return {"ttl": self.ttl, "hits": self.hits, "misses": self.misses}
+
+def format_uptime(seconds):
+    """Время работы в виде ЧЧ:ММ:СС"""
+    hours = int(seconds // 3600)
+    minutes = int((seconds % 3600) // 60)
+    return f"{hours:02d}:{minutes:02d}:{int(seconds % 60):02d}"
+
+def compress_response(response):
+    """Сжатие текстового ответа gzip, если клиент его принимает
+
+    Тело с ETag сжимается один раз и берётся из кэша. ETag сжатого
+    представления становится слабым (как у nginx): If-None-Match сравнивается
+    по слабому правилу, и 304 работает для обоих представлений.
+    """
+    response.vary.add('Accept-Encoding')
+    if (response.status_code != 200 or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in GZIP_MIMETYPES
+            or 'gzip' not in request.headers.get('Accept-Encoding', '')):
+        return response
+    data = response.get_data()
+    if len(data) < GZIP_MIN_SIZE:
+        return response
+    etag, weak = response.get_etag()
+    if etag:
+        body = _gzip_cache.get(etag)
+        if body is None:
+            body = gzip.compress(data, GZIP_LEVEL)
+            if len(_gzip_cache) >= 16:
+                _gzip_cache.clear()
+            _gzip_cache[etag] = body
+        response.set_etag(etag, weak=True)
+    else:
+        body = gzip.compress(data, GZIP_LEVEL)
+    response.set_data(body)
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+_gzip_cache = {}
+
+def create_app(bot=None):
     """Создание Flask приложения"""
     app = Flask(__name__)
     
+    css_etag = hashlib.sha1(HOME_CSS.encode('utf-8')).hexdigest()[:16]
+    css_modified = time.time()
+    home_page = HomePage(content.current())
+    stats_cache = TTLCache()
+    
+    @app.after_request
+    def after_request(response):
+        return compress_response(response)
+    
+    @app.route('/style.css')
+    def style():
+        response = FlaskResponse(HOME_CSS, mimetype='text/css')
+        response.set_etag(css_etag)
+        response.last_modified = css_modified
+        response.cache_control.public = True
+        response.cache_control.max_age = 86400
+        return response.make_conditional(request)
+    
     @app.route('/')
     def home():
-        total_requests = sum(button_stats.values())
-        uptime_seconds = time.time() - start_time
-        hours = int(uptime_seconds // 3600)
-        minutes = int((uptime_seconds % 3600) // 60)
-        seconds = int(uptime_seconds % 60)
-        uptime_str = f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+        nonlocal home_page
+        table = content.current()
+        if home_page.table is not table:
+            home_page = HomePage(table)
+        total_requests, uptime = stats_cache.get("home", lambda: (
+            sum(stats_store.snapshot().values()), format_uptime(time.time() - start_time)))
         
-        return f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <title>🤖 Бот кафедры ТиМ МФОР</title>
-            <meta charset="utf-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1">
-            <style>
-                body {{ 
-                    font-family: Arial, sans-serif; 
-                    max-width: 800px; 
-                    margin: 0 auto; 
-                    padding: 20px;
-                    background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                    color: white;
-                }}
-                .container {{
-                    background: rgba(255,255,255,0.1);
-                    backdrop-filter: blur(10px);
-                    padding: 30px;
-                    border-radius: 15px;
-                    box-shadow: 0 8px 32px rgba(0,0,0,0.1);
-                }}
-                .status {{ 
-                    padding: 15px; 
-                    border-radius: 10px; 
-                    margin: 20px 0; 
-                    text-align: center;
-                }}
-                .running {{ 
-                    background: rgba(76, 175, 80, 0.2); 
-                    border: 2px solid #4CAF50;
-                }}
-                a {{ 
-                    color: #ffeb3b; 
-                    text-decoration: none; 
-                    font-weight: bold;
-                }}
-                a:hover {{ 
-                    text-decoration: underline; 
-                }}
-                .stats-grid {{
-                    display: grid;
-                    grid-template-columns: repeat(auto-fit, minmax(200px, 1fr));
-                    gap: 15px;
-                    margin: 20px 0;
-                }}
-                .stat-item {{
-                    background: rgba(255,255,255,0.1);
-                    padding: 15px;
-                    border-radius: 10px;
-                    text-align: center;
-                }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <h1>🤖 Telegram Bot</h1>
-                <h2>Кафедра теории и методики массовой физкультурно-оздоровительной работы</h2>
-                <p>НГУ им. П.Ф. Лесгафта, Санкт-Петербург</p>
-                
-                <div class="status running">
-                    <strong>Статус:</strong> ✅ Активен и работает
-                </div>
-                
-                <div class="stats-grid">
-                    <div class="stat-item">
-                        <h3>📊 Всего запросов</h3>
-                        <p>{total_requests}</p>
-                    </div>
-                    <div class="stat-item">
-                        <h3>🕒 Время работы</h3>
-                        <p>{uptime_str}</p>
-                    </div>
-                </div>
-                
-                <h2>📋 Меню бота</h2>
-                <ul>
-                    <li>📢 Новости кафедры</li>
-                    <li>🗓️ Расписание консультаций</li>
-                    <li>📚 История кафедры</li>
-                    <li>🎓 Абитуриентам</li>
-                    <li>👨‍🎓 Студентам</li>
-                    <li>⚽ Спортивная работа</li>
-                    <li>🏅 Центр тестирования ГТО</li>
-                    <li>👨‍🏫 Сотрудники кафедры</li>
-                </ul>
-                
-                <h2>🔗 Ссылки</h2>
-                <ul>
-                    <li><a href="/health">Проверить статус сервиса</a></li>
-                    <li><a href="/stats">Посмотреть статистику бота</a></li>
-                    <li><a href="https://lesgaft.spb.ru">Сайт университета</a></li>
-                </ul>
-            </div>
-        </body>
-        </html>
-        """
+        response = FlaskResponse(home_page.render(total_requests, uptime), mimetype='text/html')
+        response.set_etag(f"{home_page.etag}-{total_requests}-{uptime.replace(':', '')}")
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+    
+    @app.route(WEBHOOK_PATH, methods=['POST'])
+    def webhook():
+        secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if bot is None or not hmac.compare_digest(secret.encode(), bot.webhook_secret.encode()):
+            return "", 403
+        update = request.get_json(silent=True)
+        if not isinstance(update, dict) or "update_id" not in update:
+            return "", 400
+        # Повторную доставку того же обновления подтверждаем, но не обрабатываем
+        if not bot.journal.claim(update["update_id"]):
+            return "", 200
+        # Отвечаем сразу; при переполненных очередях Telegram повторит доставку
+        if not bot.dispatcher.submit(update, block=False):
+            bot.journal.release(update["update_id"])
+            return "", 503
+        bot.journal.advance(update["update_id"])
+        bot.journal.checkpoint(min_interval=1.0)
+        return "", 200
+    
+    @app.route('/broadcast', methods=['POST'])
+    def broadcast():
+        token = request.headers.get('X-Admin-Token', '')
+        if bot is None or not ADMIN_TOKEN or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+            return jsonify({"error": "forbidden"}), 403
+        data = request.get_json(silent=True) or {}
+        text = data.get("text", "").strip()
+        if not text:
+            return jsonify({"error": "text is required"}), 400
+        # По умолчанию текст экранируется; html=true — текст уже в разметке Telegram
+        if not data.get("html"):
+            text = html.escape(text)
+        # Ошибка в тексте дала бы 400 на каждого подписчика — проверяем до запуска
+        errors = bot.broadcaster.validate(text)
+        if errors:
+            return jsonify({"error": "invalid text", "details": errors}), 400
+        if not bot.broadcaster.start(text):
+            return jsonify({"error": "broadcast already running", "broadcast": bot.broadcaster.stats()}), 409
+        return jsonify({"status": "started", "broadcast": bot.broadcaster.stats()}), 202
     
     @app.route('/health')
     def health():
+        # 503 только если держатель опроса давно не получал обновлений:
+        # кратковременные сбои сети перезапуском не лечатся
+        stuck = bot is not None and bot.polling_stuck()
         return jsonify({
-            "status": "healthy",
+            "status": "unhealthy" if stuck else "healthy",
             "service": "telegram-bot",
             "timestamp": time.time(),
-            "environment": "production"
-        }), 200
+            "environment": "production",
+            "polling": bot.breaker.stats() if bot else None
+        }), 503 if stuck else 200
     
-    @app.route('/stats')
-    def stats():
-        return jsonify({
+    @app.route('/metrics')
+    def metrics():
+        gauges = [
+            ("process_resident_memory_bytes", "Resident memory size in bytes", resident_memory_bytes()),
+            ("bot_uptime_seconds", "Seconds since start", time.time() - start_time),
+        ]
+        counters = [
+            ("bot_requests_total", "Section button presses", sum(stats_store.snapshot().values())),
+            ("bot_log_dropped_total", "Log records dropped because the log queue was full",
+             log_pipeline.handler.dropped),
+        ]
+        if bot:
+            gauges += [
+                ("bot_dispatcher_pending", "Updates queued or being handled", bot.dispatcher.stats()["pending"]),
+                ("bot_send_queue_depth", "Outgoing requests waiting in the send queue", bot.outbox.stats()["queue_depth"]),
+            ]
+        return FlaskResponse(bot_metrics.render(gauges, counters), mimetype="text/plain; version=0.0.4")
+    
+    def build_stats(query):
+        """Тело ответа /stats; ValueError — ошибка в параметрах запроса"""
+        button_stats = stats_store.snapshot()
+        timeseries = None
+        if 'window' in query or 'granularity' in query:
+            granularity = query.get('granularity', 'hour')
+            window = parse_window(query.get('window', '24h'))
+            if granularity not in TimeSeries.GRANULARITIES:
+                raise ValueError(f"granularity must be one of {list(TimeSeries.GRANULARITIES)}")
+            step, slots = TimeSeries.GRANULARITIES[granularity]
+            points = stats_store.timeseries.series(granularity, min(window, step * slots))
+            timeseries = {
+                "granularity": granularity,
+                "window_seconds": min(window, step * slots),
+                "points": [{"start": start, "counts": counts, "total": sum(counts.values())}
+                           for start, counts in points]
+            }
+        
+        return json.dumps({
             "status": "running",
             "button_stats": button_stats,
             "total_requests": sum(button_stats.values()),
-            "uptime_seconds": time.time() - start_time
+            "uptime_seconds": time.time() - start_time,
+            "transport": bot.transport.stats() if bot else None,
+            "dispatcher": bot.dispatcher.stats() if bot else None,
+            "updates": bot.journal.stats() if bot else None,
+            "instance": {
+                "id": bot.instance_id if bot else INSTANCE_ID,
+                "poller": bot.is_poller if bot else None,
+                "poller_holder": shared_state.lease_holder("poller") if shared_state else None,
+                "shared_db": SHARED_DB or None
+            },
+            "send_queue": bot.outbox.stats() if bot else None,
+            "subscribers": len(subscribers),
+            "broadcast": bot.broadcaster.stats() if bot else None,
+            "stats_store": stats_store.stats(),
+            "audience": stats_store.audience.stats(),
+            "content": content.stats(),
+            "media": media_cache.stats(),
+            "http_cache": stats_cache.stats(),
+            "logging": log_pipeline.stats(),
+            "timeseries": timeseries
         })
     
+    @app.route('/stats')
+    def stats():
+        # Мониторинги опрашивают /stats часто: готовый JSON живёт STATS_CACHE_TTL секунд
+        try:
+            body = stats_cache.get(request.query_string, lambda: build_stats(request.args))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return FlaskResponse(body, mimetype='application/json')
+    
     return app
 
-def run_bot():
+def run_bot(bot):
     """Запуск бота в отдельном потоке"""
-    bot = TelegramBot()
     bot.run_polling()
 
-def run_flask():
+def handle_sigterm(signum, frame):
+    """Render останавливает сервис сигналом SIGTERM"""
+    raise SystemExit(0)
+
+def run_flask(bot=None):
     """Запуск Flask приложения"""
-    app = create_app()
+    app = create_app(bot)
     port = int(os.environ.get('PORT', 10000))
-    logger.info(f"🌐 Flask сервер запускается на порту {port}")
-    app.run(host='0.0.0.0', port=port, debug=False, use_reloader=False)
+    if WSGI_SERVER == 'waitress':
+        try:
+            from waitress import serve
+        except ImportError:
+            logger.warning("waitress не установлен, используется встроенный сервер Flask")
+        else:
+            logger.info("🌐 waitress запускается на порту %d, потоков: %d", port, WSGI_THREADS)
+            serve(app, host='0.0.0.0', port=port, threads=WSGI_THREADS)
+            return
+    logger.info("🌐 Flask сервер запускается на порту %d", port)
+    app.run(host='0.0.0.0', port=port, debug=False, use_reloader=False, threaded=True)
 
 # Глобальные переменные
 start_time = time.time()
 
 def main():
     """Основная функция запуска"""
-    print("=" * 60)
-    print("🚀 Запуск приложения...")
-    print("📍 Кафедра ТиМ МФОР НГУ им. П.Ф. Лесгафта")
-    print("🌐 Хостинг: Render.com")
-    print("🤖 Режим: Прямые HTTP запросы к Telegram API")
-    print("=" * 60)
+    logger.info("🚀 Запуск приложения: кафедра ТиМ МФОР НГУ им. П.Ф. Лесгафта, хостинг Render.com")
     
     # Проверяем наличие токена
     if not BOT_TOKEN:
-        print("❌ ОШИБКА: BOT_TOKEN не установлен!")
-        print("Пожалуйста, установите переменную окружения BOT_TOKEN в настройках Render")
+        logger.error("❌ BOT_TOKEN не установлен! Установите переменную окружения BOT_TOKEN в настройках Render")
         return
     
-    # Запускаем бота в отдельном потоке
-    bot_thread = threading.Thread(target=run_bot, daemon=True)
-    bot_thread.start()
-    print("✅ Telegram бот запущен в фоновом режиме")
+    bot = TelegramBot()
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            logger.error("❌ Для режима webhook нужен WEBHOOK_URL или RENDER_EXTERNAL_URL!")
+            return
+        if not bot.run_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH):
+            return
+    else:
+        # Запускаем бота в отдельном потоке
+        bot_thread = threading.Thread(target=run_bot, args=(bot,), daemon=True)
+        bot_thread.start()
     
-    print("📊 Доступные endpoints:")
-    print("   /          - Главная страница")
-    print("   /health    - Health check")
-    print("   /stats     - Статистика бота")
-    print("=" * 60)
-    print("⚡ Приложение готово к работе!")
-    print("=" * 60)
+    logger.info("⚡ Приложение готово к работе: /, /health, /stats, /metrics%s",
+                f", {WEBHOOK_PATH}" if BOT_MODE == "webhook" else "")
     
-    # Запускаем Flask (блокирующий вызов)
-    run_flask()
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    stats_store.start()
+    try:
+        # Запускаем Flask (блокирующий вызов)
+        run_flask(bot)
+    finally:
+        bot.shutdown()
+        stats_store.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file